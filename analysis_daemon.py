@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Analysis service. Loads the configuration, estimators and the output
+stage once, and then analyzes each sweep exactly once, as soon as the
+receiver has marked the manifest of the sweep complete. The data
+directory is watched with inotify, so the analysis starts as soon as the
+last raw voltage file of a sweep has been written.
+
+In follow mode (follow=true in the configuration) each frequency is
+decoded as soon as its raw voltage file has been written, and a partial
+ionogram is published after each frequency.
+
+Run one for each configuration (e.g., vertical and oblique).
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+
+import analyze_ionograms
+import dir_watch
+import estimation_cache
+import iono_config
+import npy_store
+import output_stage
+import prc_lib as p
+import sweep_manifest
+
+
+def sweep_complete(ic, t0, data_path):
+    """ True if the receiver has written all raw voltage files of the sweep """
+    m=sweep_manifest.read_manifest(data_path, t0)
+    return(m is not None and m["complete"])
+
+
+class analysis_daemon:
+    def __init__(self, ic, data_path, output, timeout=10.0):
+        self.ic=ic
+        self.data_path=data_path
+        self.output=output
+        # how often to check for incomplete sweeps, if no files are written
+        self.timeout=timeout
+        self.watch=dir_watch.dir_watch(data_path)
+        # follow mode: ionogram accumulators of sweeps in progress
+        self.following={}
+
+        # sweeps up to this one have been analyzed or abandoned.
+        # after a restart, continue after the newest sweep
+        # that already has an ionogram
+        self.last_t0=0
+        for t0 in sweep_manifest.sweeps(data_path):
+            if os.path.exists(analyze_ionograms.ionogram_fname(ic, t0)):
+                self.last_t0=t0
+
+        # warm up estimators before the first sweep
+        p.precompute_decoders(ic.decoding_codes,
+                              decoder=ic.decoder,
+                              n_ranges=ic.code_n_range_gates,
+                              n_workers=ic.estimator_workers)
+
+    def pending(self):
+        """ sweeps that have not been analyzed yet, oldest first """
+        return([t0 for t0 in sweep_manifest.sweeps(self.data_path) if t0 > self.last_t0])
+
+    def abandon(self, t0, pending):
+        """
+        True if sweep t0, which is incomplete, will not be completed:
+        a newer sweep is complete, or the next sweep has also ended.
+        """
+        newer=[t1 for t1 in pending if t1 > t0]
+        return(any([sweep_complete(self.ic, t1, self.data_path) for t1 in newer]) or
+               time.time() > t0+2*self.ic.s.sweep_len_s)
+
+    def freq_end(self, t0, fi):
+        """ time when the recording of frequency fi of sweep t0 ends """
+        return(t0+self.ic.s.pars(fi)[1]+self.ic.s.freq_dur)
+
+    def finish(self, t0):
+        self.last_t0=max(self.last_t0, t0)
+        # keep two sweeps in ringbuffer to allow oblique analysis to also finish
+        analyze_ionograms.delete_old_files(t0-self.ic.s.sweep_len_s*2, data_path=self.data_path)
+
+    def step(self):
+        """
+        Analyze all complete sweeps that haven't been analyzed yet, in order.
+        Incomplete sweeps are waited for, unless they are abandoned.
+        Returns the number of sweeps (or in follow mode, frequencies) analyzed.
+        """
+        if self.ic.follow:
+            return(self.follow_step())
+        n_analyzed=0
+        pending=self.pending()
+        for t0 in pending:
+            if sweep_complete(self.ic, t0, self.data_path):
+                print("Analyzing sweep %d %s" % (t0, datetime.fromtimestamp(time.time()).strftime("%FT%T")))
+                try:
+                    analyze_ionograms.analyze_sweep(self.ic, t0, data_path=self.data_path, output=self.output)
+                except Exception as e:
+                    # don't try the same sweep again
+                    print("Analysis of sweep %d failed (%s). Skipping." % (t0, str(e)))
+                self.last_t0=t0
+                n_analyzed+=1
+            elif self.abandon(t0, pending):
+                print("Sweep %d is incomplete. Skipping." % (t0))
+                self.last_t0=t0
+            else:
+                # wait for the receiver to finish writing this sweep
+                break
+        return(n_analyzed)
+
+    def follow_step(self):
+        """
+        Decode all frequencies that have been recorded, but not analyzed yet.
+        Sweeps are finished when all frequencies are done, or when they
+        are abandoned, in which case the ionogram is finished
+        with the frequencies that were recorded. Frequencies whose raw
+        voltage can't be found for timeout seconds after they were
+        recorded are skipped.
+        """
+        n_analyzed=0
+        pending=self.pending()
+        for t0 in sorted(set(pending) | set(self.following.keys())):
+            m=sweep_manifest.read_manifest(self.data_path, t0)
+            if m is None:
+                # the manifest has been deleted
+                m={"files":{}, "complete":False}
+            if t0 not in self.following:
+                print("Following sweep %d" % (t0))
+                self.following[t0]=analyze_ionograms.ionogram_accumulator(self.ic, t0)
+            acc=self.following[t0]
+
+            for fi in sorted([int(k) for k in m["files"].keys()]):
+                if not acc.done(fi) and fi not in acc.skipped:
+                    try:
+                        if analyze_ionograms.analyze_frequency(self.ic, acc, fi, data_path=self.data_path, output=self.output):
+                            n_analyzed+=1
+                        elif time.time() > self.freq_end(t0, fi)+self.timeout:
+                            # listed in the manifest, but the raw voltage is gone
+                            print("Sweep %d frequency %d not found. Skipping." % (t0, fi))
+                            acc.skip(fi)
+                    except Exception as e:
+                        print("Analysis of sweep %d frequency %d failed (%s). Skipping." % (t0, fi, str(e)))
+                        acc.skip(fi)
+
+            if m["complete"] or self.abandon(t0, pending):
+                if not m["complete"]:
+                    print("Sweep %d is incomplete. %d/%d frequencies." % (t0, acc.n_done(), self.ic.s.n_freqs))
+                try:
+                    if acc.n_done() > 0:
+                        acc.finish(self.output)
+                except Exception as e:
+                    print("Finishing sweep %d failed (%s)" % (t0, str(e)))
+                del self.following[t0]
+                self.finish(t0)
+        return(n_analyzed)
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    n_analyzed=self.step()
+                except Exception as e:
+                    # e.g., a manifest that can't be read. try again later
+                    print("Analysis step failed (%s)" % (str(e)))
+                    n_analyzed=0
+                if n_analyzed == 0:
+                    self.watch.wait(self.timeout)
+        finally:
+            self.watch.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--config',
+        default="config/default.ini",
+        help='''Configuration file. (default: %(default)s)''',
+    )
+    op = parser.parse_args()
+
+    ic = iono_config.get_config(config=op.config, write_waveforms=True)
+    estimation_cache.set_max_mb(ic.estimation_cache_mb)
+    npy_store.set_max_mb(ic.estimation_store_mb)
+    print("Starting analysis service %s" % (datetime.fromtimestamp(time.time()).strftime("%FT%T")))
+    with output_stage.output_stage(ic.output_workers, ic.output_queue) as output:
+        d=analysis_daemon(ic, ic.data_dir, output)
+        d.run()
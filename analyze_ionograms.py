@@ -5,13 +5,21 @@ import matplotlib
 import numpy as n
 import matplotlib.pyplot as plt
 import prc_lib as p
+import estimation_cache
 import glob
 import os
 import time
 import re
+import multiprocessing
+import npy_store
+import warnings
 
+import output_stage
+import quicklook
 import stuffr
 import sweep
+import sweep_manifest
+import shm_ring
 import h5py
 import iono_config
 import scipy.constants as c
@@ -27,24 +35,31 @@ def save_raw_data(fname="tmp.h5",
                   freqs=0,
                   station=0,
                   sr=100e3,
-                  freq_dur=4):
+                  freq_dur=4,
+                  freq_dec=None):
 
     """
     save all relevant information that will allow an ionogram
-    and range-Doppler spectra to be calculated
+    and range-Doppler spectra to be calculated.
+    freq_dec is the extra decimation of each frequency: the
+    first len(z_all[i])/freq_dec[i] samples of frequency i
+    are sampled at sr/freq_dec[i].
     """
     # 32 bit complex
     z_re=n.array(n.real(z_all), dtype=n.float16)
     z_im=n.array(n.imag(z_all), dtype=n.float16)
     print("saving raw complex voltage %s" % (fname))
-    with h5py.File(fname, "w") as ho:
-        ho["z_re"]=z_re
-        ho["t0"]=t0
-        ho["z_im"]=z_im
-        ho["freqs"]=freqs
-        ho["freq_dur"]=freq_dur
-        ho["sample_rate"]=sr
-        ho["station_id"]=station
+    with output_stage.atomic_file(fname) as tmp_fname:
+        with h5py.File(tmp_fname, "w") as ho:
+            ho["z_re"]=z_re
+            ho["t0"]=t0
+            ho["z_im"]=z_im
+            ho["freqs"]=freqs
+            ho["freq_dur"]=freq_dur
+            ho["sample_rate"]=sr
+            ho["station_id"]=station
+            if freq_dec is not None:
+                ho["freq_dec"]=freq_dec
 
 
 def delete_old_files(t0, data_path="/dev/shm"):
@@ -61,204 +76,497 @@ def delete_old_files(t0, data_path="/dev/shm"):
                 os.system("rm %s" % (f))
         except Exception as e:
             print("error deleting file")
+    sweep_manifest.delete_old_manifests(t0, data_path)
 
 
-def analyze_latest_sweep(ic, data_path="/dev/shm"):
+def decode_sweep(ic, zs, fis=None):
     """
-    Analyze an ionogram, make some plots, save some data
+    Decode frequencies fis (default: all) of a sweep. Frequencies that use
+    the same code are decoded in stacks of ic.decode_stack frequencies, with
+    one matrix-matrix product per stack.
     """
-    # TODO: save raw voltage to file,
-    # then analyze raw voltage file with common program
-    # figure out what cycle is ready
-    s=ic.s
-    n_rg=ic.n_range_gates
-    t0=n.uint64(n.floor(time.time()/(s.sweep_len_s))*ic.s.sweep_len_s-ic.s.sweep_len_s)
-
-    sfreqs=n.array(ic.s.freqs)
-    iono_freqs=sfreqs[:, 0]
-    fmax=n.max(iono_freqs)
-    #
-    plot_df=0.1
-
-    n_plot_freqs=int((fmax+0.5)/plot_df)
-    iono_p_freq=n.arange(n_plot_freqs)*plot_df  # n.linspace(0,fmax+0.5,num=n_plot_freqs)
-    I=n.zeros([n_plot_freqs, n_rg], dtype=n.float32)
-    IS=n.zeros([sfreqs.shape[0], n_rg], dtype=n.float32)
-
-    # number of transmit "pulses"
-    n_t=int(ic.s.freq_dur*1000000/(ic.code_len*ic.dec))
-
-    all_spec=n.zeros([ic.s.n_freqs, n_t, n_rg], dtype=n.float32)
+    if fis is None:
+        fis=range(ic.s.n_freqs)
+    results={}
+
+    # build estimators for all codes in parallel
+    p.precompute_decoders(ic.decoding_codes,
+                          decoder=ic.decoder,
+                          n_ranges=ic.code_n_range_gates,
+                          n_workers=ic.estimator_workers)
+
+    for code_idx in range(ic.n_codes):
+        code_fis=[fi for fi in fis if ic.s.code_idx(fi) == code_idx]
+        for si in range(0, len(code_fis), ic.decode_stack):
+            stack_fis=code_fis[si:(si+ic.decode_stack)]
+            res=p.analyze_prc_stack([zs[fi] for fi in stack_fis],
+                                    code=ic.decoding_codes[code_idx],
+                                    rfi_rem=False,
+                                    spec_rfi_rem=True,
+                                    n_ranges=ic.code_n_range_gates[code_idx],
+                                    decoder=ic.decoder)
+            for fi, r in zip(stack_fis, res):
+                results[fi]=r
+    return(results)
+
+
+def frequency_products(ic, i, res):
+    """
+    Range-time and range-Doppler power of one frequency.
+    Returns the peak SNR of each range gate, the noise floor,
+    and the data needed to plot the frequency.
+    Codes with extra decimation have fewer, longer range gates.
+    The peak SNR is repeated to the range gates of the ionogram.
+    """
+    q=ic.code_decs[ic.s.code_idx(i)]
+    N, n_rg=res["res"].shape
 
     # IPP length
     dt=ic.dec*ic.code_len/1e6
 
     # range step
-    dr = ic.dec*c.c/ic.sample_rate/2.0/1e3
+    dr0 = ic.dec*c.c/ic.sample_rate/2.0/1e3
+    dr = q*dr0
 
     rvec=n.arange(float(n_rg))*dr
     p_rvec=n.arange(float(n_rg)+1)*dr
-    fvec=n.fft.fftshift(n.fft.fftfreq(n_t, d=dt))
+    fvec=n.fft.fftshift(n.fft.fftfreq(N, d=dt))
+    p_tvec=n.arange(N+1, dtype=n.float64)*dt
 
-    hdname=stuffr.unix2iso8601_dirname(t0, ic)
-    dname="%s/%s" % (ic.ionogram_path, hdname)
-    os.system("mkdir -p %s" % (dname))
-
-    print("Duration of each frequency: {}".format(ic.s.freq_dur))
-    z_all=n.zeros([ic.s.n_freqs, int(ic.s.freq_dur*100000)], dtype=n.complex64)
-
-    noise_floors=[]
-
-    for i in range(ic.s.n_freqs):
-        fname="%s/raw-%d-%03d.bin" % (data_path, t0, i)
-        if os.path.exists(fname):
-            z=n.fromfile(fname, dtype=n.complex64)
-            z_all[i, :]=z
-            N=len(z)
-            code_idx=ic.s.code_idx(i)
-
-            if ic.spectral_whitening:
-                # reduce receiver noise due to narrow band
-                # broadcast signals by trying to filter them out
-                if ic.pulse_lengths[code_idx] > 0:
-                    z = p.spectral_filter_pulse(z,
-                                                ipp=ic.ipps[code_idx],
-                                                pulse_len=ic.pulse_lengths[code_idx])
-
-            res=p.analyze_prc2(z,
-                               code=ic.orig_codes[code_idx],
-                               cache_idx=code_idx+1000000*ic.station_id,
-                               rfi_rem=False,
-                               spec_rfi_rem=True,
-                               n_ranges=n_rg)
-
-            plt.figure(figsize=(1.5*8, 1.5*6))
-            plt.rc('font', size=15)
-            plt.rc('axes', titlesize=20)
-            plt.subplot(121)
-
-            tvec=n.arange(int(N/ic.code_len), dtype=n.float64)*dt
-            p_tvec=n.arange(int(N/ic.code_len)+1, dtype=n.float64)*dt
-            with n.errstate(divide='ignore'):
-                dBr=10.0*n.log10(n.transpose(n.abs(res["res"])**2.0))
-            noise_floor=n.nanmedian(dBr)
-            noise_floor_0=noise_floor
-            noise_floors.append(noise_floor_0)
-            dBr=dBr-noise_floor
-            dB_max=n.nanmax(dBr)
-            plt.pcolormesh(p_tvec, p_rvec-ic.range_shift*dr, dBr, vmin=0, vmax=ic.max_plot_dB)
-            plt.xlabel("Time (s)")
-            plt.title("Range-Time Power f=%d (dB)\nnoise_floor=%1.2f (dB) peak SNR=%1.2f"
-                      % (i, noise_floor, dB_max))
-            plt.ylabel("Range (km)")
-            plt.ylim([-10, ic.max_plot_range])
-
-            plt.colorbar()
-            plt.subplot(122)
-#            S=n.abs(res["spec"])**2.0
-            S=res["spec_snr"]
-
-            #sw=n.fft.fft(n.repeat(1.0/4,4),S.shape[0])
-            #for rg_id in range(S.shape[1]):
-            #    S[:,rg_id]=n.roll(n.real(n.fft.ifft(n.fft.fft(S[:,rg_id])*sw)),-2)
-
-            all_spec[i, :, :]=S
-            # 100 kHz steps for ionogram freqs
-            pif=n.argmin(n.abs(iono_freqs[i]-iono_p_freq))
-#            pif=int(iono_freqs[i]/0.1)
-
-            # collect peak SNR across all doppler frequencies
-            I[pif, :]+=n.max(S, axis=0)
-            IS[i, :]=n.max(S, axis=0)
-
-            # SNR in dB scale
-            with n.errstate(divide='ignore'):
-                dBs=10.0*n.log10(n.transpose(S))
-            noise_floor=n.nanmedian(dBs)
-            max_dB=n.nanmax(dBs)
-            plt.pcolormesh(fvec, rvec-ic.range_shift*dr, dBs, vmin=0, vmax=ic.max_plot_dB)
-            plt.ylim([-10, ic.max_plot_range])
-
-            plt.title("Range-Doppler Power (dB)\nnoise_floor=%1.2f (dB) peak SNR=%1.2f (dB)"
-                      % (noise_floor, max_dB))
-            plt.xlabel("Frequency (Hz)")
-            plt.ylabel("Virtual range (km)")
-
-            cb=plt.colorbar()
-            cb.set_label("SNR (dB)")
-            plt.tight_layout()
-
-            plt.savefig("%s/iono-%03d.png" % (dname, i))
-            plt.close()
-            plt.clf()
-        else:
-            return(0)
-            print("file %s not found" % (fname))
-
-    i_fvec=n.zeros(ic.s.n_freqs)
-    for fi in range(ic.s.n_freqs):
-        i_fvec[fi]=s.freq(fi)
     with n.errstate(divide='ignore'):
-        dB=10.0*n.log10(n.transpose(I))
-    dB[n.isinf(dB)]=n.nan
-    noise_floor=n.nanmedian(dB)
-
-    for i in range(dB.shape[1]):
-        dB[:, i]=dB[:, i]-n.nanmedian(dB[:, i])
-
-    dB[n.isnan(dB)]=-3
-
-    noise_floor_0=n.mean(n.array(noise_floors))
-
+        dBr=10.0*n.log10(n.transpose(n.abs(res["res"])**2.0))
+    noise_floor=n.nanmedian(dBr)
+    noise_floor_0=noise_floor
+    dBr=dBr-noise_floor
+    dB_max=n.nanmax(dBr)
+    title_r="Range-Time Power f=%d (dB)\nnoise_floor=%1.2f (dB) peak SNR=%1.2f" % (i, noise_floor, dB_max)
+
+#    S=n.abs(res["spec"])**2.0
+    S=res["spec_snr"]
+
+    # collect peak SNR across all doppler frequencies
+    S_max=n.max(S, axis=0)
+    if q > 1:
+        S_max=n.repeat(S_max, q)[0:ic.n_range_gates]
+
+    # SNR in dB scale
+    with n.errstate(divide='ignore'):
+        dBs=10.0*n.log10(n.transpose(S))
+    noise_floor=n.nanmedian(dBs)
+    max_dB=n.nanmax(dBs)
+    title_s="Range-Doppler Power (dB)\nnoise_floor=%1.2f (dB) peak SNR=%1.2f (dB)" % (noise_floor, max_dB)
+
+    plot={"p_tvec":p_tvec,
+          "p_rvec":p_rvec-ic.range_shift*dr0,
+          "dBr":n.array(dBr, dtype=n.float32),
+          "title_r":title_r,
+          "fvec":fvec,
+          "rvec":rvec-ic.range_shift*dr0,
+          "dBs":n.array(dBs, dtype=n.float32),
+          "title_s":title_s}
+    return(S_max, noise_floor_0, plot)
+
+
+def save_quicklook(fname, plot, max_plot_dB, max_plot_range):
+    """
+    Plot range-time and range-Doppler power of one frequency.
+    """
+    with output_stage.atomic_file(fname) as tmp_fname:
+        quicklook.range_time_doppler(tmp_fname, plot, 0, max_plot_dB, [-10, max_plot_range])
+
+
+def save_ionogram_plot(fname,
+                       links,
+                       iono_p_freq,
+                       fmax,
+                       rvec,
+                       dB,
+                       title,
+                       max_plot_dB,
+                       max_plot_range,
+                       xlim):
+    """
+    Plot ionogram, then point the symbolic links in links
+    (a list of (target, link name) pairs) to it.
+    """
     plt.figure(figsize=(1.5*8, 1.5*6))
-    max_dB=n.nanmax(dB)
     plt.pcolormesh(n.concatenate((iono_p_freq, [fmax+0.1])),
-                   rvec-ic.range_shift*1.5, dB, vmin=0, vmax=ic.max_plot_dB)
-    plt.title("%s %s UT\nnoise_floor=%1.2f (dB) peak SNR=%1.2f"
-              % (ic.instrument_name, stuffr.unix2datestr(t0), noise_floor_0, max_dB))
+                   rvec, dB, vmin=0, vmax=max_plot_dB)
+    plt.title(title)
     plt.xlabel("Frequency (MHz)")
     plt.ylabel("Virtual range (km)")
     #plt.colorbar()
     cb=plt.colorbar()
     cb.set_label("SNR (dB)")
 
-    plt.ylim([-10, ic.max_plot_range])
-    plt.xlim([n.min(iono_freqs)-0.5, n.max(iono_freqs)+0.5])
+    plt.ylim([-10, max_plot_range])
+    plt.xlim(xlim)
     plt.tight_layout()
 
-    datestr=stuffr.unix2iso8601(t0)
-    ofname="%s/%s.png" % (dname, datestr.replace(':','.'))
-    print("Saving ionogram %s" % (ofname))
-    plt.savefig(ofname)
+    print("Saving ionogram %s" % (fname))
+    with output_stage.atomic_file(fname) as tmp_fname:
+        plt.savefig(tmp_fname, format="png")
     plt.clf()
     plt.close()
-    # make link to latest plot
-    os.system("ln -sf %s latest.png" % (ofname))
-
-    ofname="%s/raw-%s.h5" % (dname, datestr.replace(':','.'))
-    if ic.save_raw_voltage:
-        save_raw_data(ofname,
-                      t0,
-                      z_all,
-                      ic.s.freqs,
-                      ic.station_id,
-                      sr=ic.sample_rate/ic.dec,
-                      freq_dur=ic.s.freq_dur)
-
-    iono_ofname="%s/ionogram-%s.h5" % (dname, datestr.replace(':','.'))
-    print("Saving ionogram %s" % (iono_ofname))
-    with h5py.File(iono_ofname, "w") as ho:
-        ho["I"]=IS
-        ho["I_rvec"]=rvec
-        ho["t0"]=t0
-        ho["lat"]=ic.lat
-        ho["lon"]=ic.lon
-        ho["I_fvec"]=sfreqs
-        ho["ionogram_version"]=1
+
+    for target, link_name in links:
+        output_stage.atomic_symlink(target, link_name)
+
+
+def save_ionogram(fname, IS, rvec, t0, lat, lon, sfreqs):
+    """
+    Save ionogram (peak SNR for each frequency and range gate)
+    """
+    print("Saving ionogram %s" % (fname))
+    with output_stage.atomic_file(fname) as tmp_fname:
+        with h5py.File(tmp_fname, "w") as ho:
+            ho["I"]=IS
+            ho["I_rvec"]=rvec
+            ho["t0"]=t0
+            ho["lat"]=lat
+            ho["lon"]=lon
+            ho["I_fvec"]=sfreqs
+            ho["ionogram_version"]=1
+
+
+def analyze_frequencies(ic, zs, fis):
+    """
+    Decode frequencies fis of a sweep.
+    Returns a list of (frequency index, peak SNR of each range gate,
+    noise floor, quicklook plot data)
+    """
+    results=decode_sweep(ic, zs, fis)
+    out=[]
+    for fi in fis:
+        out.append((fi,)+frequency_products(ic, fi, results[fi]))
+        del results[fi]
+    return(out)
+
+
+# sweep being analyzed, inherited by forked worker processes,
+# so that the raw voltage doesn't need to be sent to them
+worker_sweep={}
+
+
+def analyze_frequencies_worker(fis):
+    return(analyze_frequencies(worker_sweep["ic"], worker_sweep["zs"], fis))
+
+
+def analyze_frequencies_parallel(ic, zs):
+    """
+    Spread the frequencies of a sweep over ic.analysis_workers processes.
+    Estimators are created before forking, so that all workers share them
+    read-only: memory mapped matrices share the page cache, and other
+    estimators are shared copy-on-write.
+    """
+    p.precompute_decoders(ic.decoding_codes,
+                          decoder=ic.decoder,
+                          n_ranges=ic.code_n_range_gates,
+                          n_workers=ic.estimator_workers)
+
+    # each task is a stack of frequencies that can be decoded together
+    tasks=[]
+    for code_idx in range(ic.n_codes):
+        code_fis=[fi for fi in range(ic.s.n_freqs) if ic.s.code_idx(fi) == code_idx]
+        stack=max(1, min(ic.decode_stack, int(n.ceil(len(code_fis)/float(ic.analysis_workers)))))
+        for si in range(0, len(code_fis), stack):
+            tasks.append(code_fis[si:(si+stack)])
+
+    worker_sweep["ic"]=ic
+    worker_sweep["zs"]=zs
+    try:
+        with multiprocessing.get_context("fork").Pool(ic.analysis_workers) as pool:
+            out=[]
+            for task_out in pool.imap_unordered(analyze_frequencies_worker, tasks):
+                out+=task_out
+    finally:
+        worker_sweep.clear()
+    return(out)
+
+
+def raw_fname(data_path, t0, i):
+    """ raw voltage file of frequency i of the sweep starting at t0 """
+    return("%s/raw-%d-%03d.bin" % (data_path, t0, i))
+
+
+def ionogram_fname(ic, t0):
+    """ ionogram data file of the sweep starting at t0 """
+    dname="%s/%s" % (ic.ionogram_path, stuffr.unix2iso8601_dirname(t0, ic))
+    datestr=stuffr.unix2iso8601(t0)
+    return("%s/ionogram-%s.h5" % (dname, datestr.replace(':','.')))
+
+
+def latest_sweep_t0(ic):
+    """ start time of the last sweep that has ended """
+    return(n.uint64(n.floor(time.time()/(ic.s.sweep_len_s))*ic.s.sweep_len_s-ic.s.sweep_len_s))
+
+
+def analyze_latest_sweep(ic, data_path="/dev/shm", output=None):
+    """
+    Analyze the last sweep that has ended
+    """
+    return(analyze_sweep(ic, latest_sweep_t0(ic), data_path=data_path, output=output))
+
+
+def read_frequency(ic, t0, i, data_path="/dev/shm"):
+    """
+    Read raw voltage of frequency i of sweep t0, and apply spectral
+    whitening if enabled. Returns the raw and the whitened voltage,
+    or None, None if the file is not found.
+    With the shared memory transport, the raw voltage is copied out
+    of the ring buffer, so the receiver can overwrite it while
+    the frequency is being decoded.
+    """
+    if ic.transport == "shm":
+        ring=shm_ring.get_ring(ic.shm_name)
+        z_raw=None if ring is None else ring.read(t0, i)
+        if z_raw is None:
+            # the receiver may have created a new ring
+            ring=shm_ring.reattach(ic.shm_name)
+            z_raw=None if ring is None else ring.read(t0, i)
+        if z_raw is None:
+            print("sweep %d frequency %d not found in shared memory %s" % (t0, i, ic.shm_name))
+            return(None, None)
+    else:
+        fname=raw_fname(data_path, t0, i)
+        if not os.path.exists(fname):
+            print("file %s not found" % (fname))
+            return(None, None)
+        z_raw=n.fromfile(fname, dtype=n.complex64)
+
+    z=z_raw
+    code_idx=ic.s.code_idx(i)
+    # extra decimation of the code
+    q=ic.code_decs[code_idx]
+
+    if ic.spectral_whitening:
+        # reduce receiver noise due to narrow band
+        # broadcast signals by trying to filter them out
+        if ic.pulse_lengths[code_idx] > 0:
+            z = p.spectral_filter_pulse(z,
+                                        ipp=int(ic.ipps[code_idx]/q),
+                                        pulse_len=int(n.ceil(ic.pulse_lengths[code_idx]/float(q))))
+    return(z_raw, z)
+
+
+class ionogram_accumulator:
+    def __init__(self, ic, t0):
+        """
+        Ionogram of the sweep starting at t0, which is
+        updated one frequency at a time.
+        """
+        self.ic=ic
+        self.t0=n.uint64(t0)
+        n_rg=ic.n_range_gates
+
+        self.sfreqs=n.array(ic.s.freqs)
+        self.iono_freqs=self.sfreqs[:, 0]
+        self.fmax=n.max(self.iono_freqs)
+        #
+        plot_df=0.1
+
+        n_plot_freqs=int((self.fmax+0.5)/plot_df)
+        self.iono_p_freq=n.arange(n_plot_freqs)*plot_df  # n.linspace(0,fmax+0.5,num=n_plot_freqs)
+        self.I=n.zeros([n_plot_freqs, n_rg], dtype=n.float32)
+        self.IS=n.zeros([self.sfreqs.shape[0], n_rg], dtype=n.float32)
+        self.noise_floors={}
+        # frequencies that can't be analyzed
+        self.skipped=set()
+
+        # range step
+        dr = ic.dec*c.c/ic.sample_rate/2.0/1e3
+
+        self.rvec=n.arange(float(n_rg))*dr
+
+        self.hdname=stuffr.unix2iso8601_dirname(self.t0, ic)
+        self.dname="%s/%s" % (ic.ionogram_path, self.hdname)
+        os.system("mkdir -p %s" % (self.dname))
+        self.datestr=stuffr.unix2iso8601(self.t0).replace(':','.')
+
+        self.z_all=None
+        if ic.save_raw_voltage:
+            self.z_all=n.zeros([ic.s.n_freqs, int(ic.s.freq_dur*ic.sample_rate/ic.dec)], dtype=n.complex64)
+
+    def n_done(self):
+        """ number of frequencies added so far """
+        return(len(self.noise_floors))
+
+    def done(self, i):
+        return(i in self.noise_floors)
+
+    def skip(self, i):
+        """ leave out frequency i """
+        self.skipped.add(i)
+
+    def add(self, i, S_max, noise_floor, z_raw=None):
+        """
+        Add peak SNR of each range gate for frequency i,
+        and the raw voltage if it is saved.
+        """
+        # 100 kHz steps for ionogram freqs
+        pif=n.argmin(n.abs(self.iono_freqs[i]-self.iono_p_freq))
+#        pif=int(iono_freqs[i]/0.1)
+        self.I[pif, :]+=S_max
+        self.IS[i, :]=S_max
+        self.noise_floors[i]=noise_floor
+        if self.z_all is not None and z_raw is not None:
+            # frequencies with extra decimation only fill the start of the row
+            self.z_all[i, 0:len(z_raw)]=z_raw
+
+    def image(self):
+        """
+        Ionogram in dB relative to the median of each range gate,
+        and the mean noise floor of the frequencies.
+        """
+        with n.errstate(divide='ignore'):
+            dB=10.0*n.log10(n.transpose(self.I))
+        dB[n.isinf(dB)]=n.nan
+
+        with warnings.catch_warnings():
+            # range gates of frequencies that are not done yet are all NaN
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            for i in range(dB.shape[1]):
+                dB[:, i]=dB[:, i]-n.nanmedian(dB[:, i])
+
+        dB[n.isnan(dB)]=-3
+
+        noise_floor_0=n.mean(n.array([self.noise_floors[i] for i in sorted(self.noise_floors.keys())]))
+        return(dB, noise_floor_0)
+
+    def publish_partial(self, output):
+        """
+        Quicklook of the ionogram with the frequencies done so far
+        """
+        ic=self.ic
+        dB, noise_floor_0=self.image()
+        output.put(save_partial_ionogram,
+                   "%s/latest-partial.png" % (ic.ionogram_path),
+                   n.concatenate((self.iono_p_freq, [self.fmax+0.1])),
+                   self.rvec-ic.range_shift*1.5,
+                   dB,
+                   "%s %s UT (%d/%d frequencies)\nnoise_floor=%1.2f (dB) peak SNR=%1.2f"
+                   % (ic.instrument_name, stuffr.unix2datestr(self.t0), self.n_done(), ic.s.n_freqs,
+                      noise_floor_0, n.nanmax(dB)),
+                   ic.max_plot_dB,
+                   ic.max_plot_range,
+                   [n.min(self.iono_freqs)-0.5, n.max(self.iono_freqs)+0.5])
+
+    def finish(self, output):
+        """
+        Write the ionogram plot, data products and links to latest plot
+        """
+        ic=self.ic
+        t0=self.t0
+        dB, noise_floor_0=self.image()
+
+        max_dB=n.nanmax(dB)
+        ofname="%s/%s.png" % (self.dname, self.datestr)
+        # make links to latest plot
+        links=[(ofname, "latest.png"),
+               ("%s/%s.png" % (self.hdname, self.datestr), "%s/latest.png" % (ic.ionogram_path))]
+        output.put(save_ionogram_plot,
+                   ofname,
+                   links,
+                   self.iono_p_freq,
+                   self.fmax,
+                   self.rvec-ic.range_shift*1.5,
+                   dB,
+                   "%s %s UT\nnoise_floor=%1.2f (dB) peak SNR=%1.2f"
+                   % (ic.instrument_name, stuffr.unix2datestr(t0), noise_floor_0, max_dB),
+                   ic.max_plot_dB,
+                   ic.max_plot_range,
+                   [n.min(self.iono_freqs)-0.5, n.max(self.iono_freqs)+0.5])
+
+        ofname="%s/raw-%s.h5" % (self.dname, self.datestr)
+        if ic.save_raw_voltage:
+            output.put(save_raw_data,
+                       ofname,
+                       t0,
+                       self.z_all,
+                       ic.s.freqs,
+                       ic.station_id,
+                       sr=ic.sample_rate/ic.dec,
+                       freq_dur=ic.s.freq_dur,
+                       freq_dec=n.array([ic.code_decs[ic.s.code_idx(i)] for i in range(ic.s.n_freqs)]))
+        self.z_all=None
+
+        output.put(save_ionogram, ionogram_fname(ic, t0), self.IS, self.rvec, t0, ic.lat, ic.lon, self.sfreqs)
+
+
+def save_partial_ionogram(fname, fvec, rvec, dB, title, max_plot_dB, max_plot_range, xlim):
+    with output_stage.atomic_file(fname) as tmp_fname:
+        quicklook.ionogram(tmp_fname, dB, fvec, rvec, 0, max_plot_dB, xlim, [-10, max_plot_range], title)
+
+
+def analyze_frequency(ic, acc, i, data_path="/dev/shm", output=None):
+    """
+    Follow mode: decode frequency i as soon as it has been recorded,
+    add it to the ionogram accumulator acc, and publish the partial
+    ionogram. Returns False if the raw voltage file is not found.
+    """
+    if output is None:
+        output=output_stage.output_stage(n_workers=0)
+    z_raw, z=read_frequency(ic, acc.t0, i, data_path)
+    if z is None:
+        return(False)
+    res=decode_sweep(ic, {i:z}, [i])
+    S_max, noise_floor, plot=frequency_products(ic, i, res[i])
+    output.put(save_quicklook,
+               "%s/iono-%03d.png" % (acc.dname, i),
+               plot,
+               ic.max_plot_dB,
+               ic.max_plot_range)
+    acc.add(i, S_max, noise_floor, z_raw)
+    acc.publish_partial(output)
+    return(True)
+
+
+def analyze_sweep(ic, t0, data_path="/dev/shm", output=None):
+    """
+    Analyze an ionogram, make some plots, save some data.
+    Plots and files are written by the output stage output
+    (by default synchronously, before this function returns).
+    Returns False if the raw voltage files are not found.
+    """
+    if output is None:
+        output=output_stage.output_stage(n_workers=0)
+    acc=ionogram_accumulator(ic, t0)
+
+    print("Duration of each frequency: {}".format(ic.s.freq_dur))
+
+    # read the whole sweep first, so that frequencies that
+    # use the same code can be decoded together
+    zs=[]
+    z_raws=[]
+    for i in range(ic.s.n_freqs):
+        z_raw, z=read_frequency(ic, t0, i, data_path)
+        if z is None:
+            return(False)
+        z_raws.append(z_raw)
+        zs.append(z)
+
+    if ic.analysis_workers > 1:
+        freq_out=analyze_frequencies_parallel(ic, zs)
+    else:
+        freq_out=analyze_frequencies(ic, zs, range(ic.s.n_freqs))
+    del zs
+
+    # merge the results of all frequencies into the ionogram
+    for i, S_max, noise_floor, plot in sorted(freq_out, key=lambda x: x[0]):
+        output.put(save_quicklook,
+                   "%s/iono-%03d.png" % (acc.dname, i),
+                   plot,
+                   ic.max_plot_dB,
+                   ic.max_plot_range)
+        acc.add(i, S_max, noise_floor, z_raws[i])
+    del freq_out
+    del z_raws
+
+    acc.finish(output)
 
     # keep two sweeps in ringbuffer to allow oblique analysis to also finish
-    delete_old_files(t0-ic.s.sweep_len_s*2)
-    os.system("ln -sf %s/%s.png %s/latest.png" % (hdname, datestr.replace(':','.'), ic.ionogram_path))
+    delete_old_files(acc.t0-ic.s.sweep_len_s*2, data_path=data_path)
+    return(True)
 
 
 if __name__ == "__main__":
@@ -272,5 +580,8 @@ if __name__ == "__main__":
 
     # don't create waveform files.
     ic = iono_config.get_config(config=op.config, write_waveforms=True)
+    estimation_cache.set_max_mb(ic.estimation_cache_mb)
+    npy_store.set_max_mb(ic.estimation_store_mb)
     print("Starting analysis %s" % (datetime.fromtimestamp(time.time()).strftime("%FT%T")))
-    analyze_latest_sweep(ic)
+    with output_stage.output_stage(ic.output_workers, ic.output_queue) as output:
+        analyze_latest_sweep(ic, output=output)
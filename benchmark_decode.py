@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Benchmark decoding of one frequency with synthetic data, with and without
+spectral whitening of pulsed codes.
+"""
+import argparse
+import time
+
+import numpy as n
+
+import create_waveform
+import prc_lib as p
+
+
+def synthetic_measurement(code, n_periods, n_tones=5, tone_amp=30.0):
+    """ code echo at a few ranges, noise, and narrow band interference """
+    clen=len(code)
+    N=n_periods*clen
+    z=n.tile(n.roll(code, 100)+0.5*n.roll(code, 300), n_periods)
+    z=z+(n.random.randn(N)+1j*n.random.randn(N))/n.sqrt(2.0)
+    t=n.arange(N)
+    for i in range(n_tones):
+        z=z+tone_amp*n.exp(1j*2.0*n.pi*n.random.rand()*t/2.0)
+    return(n.array(z, dtype=n.complex64))
+
+
+def whitening_delay(ipp, pulse_len, N=100000):
+    """
+    Delay of the whitening filter in samples, from the cross-correlation
+    of a delta in noise with the whitened output. Should be zero.
+    """
+    z=n.array((n.random.randn(N)+1j*n.random.randn(N))/n.sqrt(2.0), dtype=n.complex64)
+    z[int(N/2)]+=1000.0
+    zw=p.spectral_filter_pulse(z, ipp=ipp, pulse_len=pulse_len)
+    xc=n.fft.ifft(n.fft.fft(zw)*n.conj(n.fft.fft(z)))
+    lag=int(n.argmax(n.abs(xc)))
+    if lag > N/2:
+        lag=lag-N
+    return(lag)
+
+
+def timeit(fun, repeats):
+    fun()
+    t0=time.time()
+    for i in range(repeats):
+        fun()
+    return((time.time()-t0)/repeats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--code_len', type=int, default=10000,
+                        help='''Code length in samples. (default: %(default)s)''')
+    parser.add_argument('--pulse_length', type=int, default=10,
+                        help='''Pulse length in samples. (default: %(default)s)''')
+    parser.add_argument('--ipp', type=int, default=500,
+                        help='''Inter-pulse period in samples. (default: %(default)s)''')
+    parser.add_argument('--n_ranges', type=int, default=1000,
+                        help='''Number of range gates. (default: %(default)s)''')
+    parser.add_argument('--n_periods', type=int, default=20,
+                        help='''Number of code periods per frequency. (default: %(default)s)''')
+    parser.add_argument('--decoder', default="auto",
+                        help='''Decoder (auto, dense, fft, sparse). (default: %(default)s)''')
+    parser.add_argument('--repeats', type=int, default=10,
+                        help='''Number of repetitions. (default: %(default)s)''')
+    op = parser.parse_args()
+
+    code=create_waveform.create_pseudo_random_code(clen=op.code_len,
+                                                   seed=0,
+                                                   pulse_length=op.pulse_length,
+                                                   ipp=op.ipp)
+    z=synthetic_measurement(code, op.n_periods)
+
+    # whitening must not shift the echoes in range
+    for ipp in [op.ipp, op.ipp+1]:
+        lag=whitening_delay(ipp, op.pulse_length)
+        print("whitening delay with ipp %d: %d samples" % (ipp, lag))
+        if lag != 0:
+            print("Whitening shifts the echoes. Exiting.")
+            exit(1)
+
+    def decode(z):
+        return(p.analyze_prc2(z, code=code, n_ranges=op.n_ranges,
+                              spec_rfi_rem=True, decoder=op.decoder))
+
+    t_decode=timeit(lambda: decode(z), op.repeats)
+    t_white=timeit(lambda: p.spectral_filter_pulse(z, ipp=op.ipp, pulse_len=op.pulse_length),
+                   op.repeats)
+
+    print("decoder %s" % (p.create_decoder(code, decoder=op.decoder, n_ranges=op.n_ranges)['decoder']))
+    print("decode per frequency %1.2f ms" % (1e3*t_decode))
+    print("spectral whitening per frequency %1.2f ms (%1.1f%% of decode time)"
+          % (1e3*t_white, 100.0*t_white/t_decode))
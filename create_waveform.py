@@ -23,6 +23,7 @@ import os
 import scipy.signal
 import matplotlib.pyplot as plt
 import iono_config
+import npy_store
 import scipy.signal as ss
 
 
@@ -37,6 +38,33 @@ def lpf(dec=10, om_factor=1.0, filter_len=4):
     return(wfun)
 
 
+def decimate(z, dec, filter_len=8):
+    """
+    Low pass filter and decimate periodic signal z by dec, with the same
+    filter as the receiver (circular convolution, centered on the kept
+    samples). Returns z unchanged if dec is 1.
+    """
+    if dec == 1:
+        return(z)
+    w=lpf(dec=dec, om_factor=0.5, filter_len=filter_len)
+    fl=len(w)
+    zf=n.roll(n.fft.ifft(n.fft.fft(w, len(z))*n.fft.fft(z)), -int(fl/2))
+    return(n.array(zf[0:len(z):dec], dtype=n.complex64))
+
+
+def code_decimation(bandwidth, sr=100e3, clen=10000, ipp=-1):
+    """
+    Extra decimation of a code with this bandwidth, when the code is
+    sampled at sr. The largest factor that keeps the bandwidth within the
+    decimated sample rate, and divides the code length (and the IPP of
+    pulsed codes).
+    """
+    dec=max(1, int(n.floor(sr/bandwidth+1e-6)))
+    while dec > 1 and (clen % dec != 0 or (ipp > 0 and ipp % dec != 0)):
+        dec-=1
+    return(dec)
+
+
 # seed is a way of reproducing the random code without
 # having to store all actual codes. the seed can then
 # act as a sort of station_id.
@@ -87,7 +115,8 @@ def filter_waveform(waveform,
                     sr=1e6,
                     bandwidth=100e3,
                     max_power_outside_band=0.01,
-                    plot=False):
+                    plot=False,
+                    return_filter_len=False):
     """
     Filter the waveform in such a way that it meets a 1% out of
     band power requirement. filter the code in such a way that there
@@ -98,6 +127,9 @@ def filter_waveform(waveform,
     can keep an eye on the direct transmitted signal range as
     part of the procedure of making sure that the transmitter and
     receiver are in sync
+
+    With return_filter_len=True, the filter length that was found
+    is also returned.
     """
     # filter window
     w = n.zeros(len(waveform), dtype=n.complex64)
@@ -135,6 +167,8 @@ def filter_waveform(waveform,
         plt.plot(a.real, a.imag, ".")
         plt.show()
 
+    if return_filter_len:
+        return(a, fl-2)
     return(a)
 
 def barker36(clen=10000,
@@ -171,6 +205,66 @@ def barker13ipps(clen=10000,
     return(code)
     
 
+def create_code(station=0, clen=10000, pulse_length=-1, ipp=1000, code_type="prn"):
+    """ code of code_type, one sample per baud """
+    if code_type=="prn":
+        code=create_pseudo_random_code(clen=clen, seed=station, pulse_length=pulse_length, ipp=ipp)
+    elif code_type=="barker13":
+        code=barker13ipps(clen=clen,ipp=ipp)
+    elif code_type=="barker36":
+        code=barker36(clen=clen,ipp=ipp)
+    else:
+        code=create_prn_dft_code(clen=clen, seed=station)
+    return(code)
+
+
+def stored_waveform(station=0,
+                    clen=10000,
+                    oversample=10,
+                    filter_output=False,
+                    sr=1e6,
+                    bandwidth=100e3,
+                    power_outside_band=0.01,
+                    pulse_length=-1,
+                    ipp=1000,
+                    code_type="prn",
+                    cache_dir="waveforms/cache"):
+    """
+    Transmit waveform, code and filter length (0 if not filtered).
+    These are stored in cache_dir under a hash of the waveform parameters,
+    so the code and the filter length search are only calculated once.
+    """
+    store=npy_store.npy_store(cache_dir)
+    # change the version string if the waveforms change
+    key=npy_store.hash_key("waveform-v1", int(station), int(clen), int(oversample), bool(filter_output),
+                           float(sr), float(bandwidth), float(power_outside_band),
+                           int(pulse_length), int(ipp), str(code_type))
+    a=store.load(key, "waveform", mmap=False)
+    code=store.load(key, "code", mmap=False)
+    fl=store.load(key, "filter_len", mmap=False)
+    if a is not None and code is not None and fl is not None:
+        return(a, code, int(fl))
+
+    code=create_code(station=station, clen=clen, pulse_length=pulse_length, ipp=ipp, code_type=code_type)
+
+    # oversample code
+    a = rep_seq(code,
+                rep=oversample)
+
+    fl=0
+    if filter_output:
+        a, fl=filter_waveform(a,
+                              sr=sr,
+                              bandwidth=bandwidth,
+                              max_power_outside_band=power_outside_band,
+                              return_filter_len=True)
+
+    store.save(key, "code", code)
+    store.save(key, "filter_len", n.array(fl))
+    store.save(key, "waveform", a)
+    return(a, code, fl)
+
+
 #
 # lets use 0.1 s code cycle and coherence assumption
 # our transmit bandwidth is 100 kHz, and with a 10e3 baud code,
@@ -187,29 +281,26 @@ def waveform_to_file(station=0,
                      pulse_length=-1,
                      ipp=1000,
                      code_type="prn",
-                     write_file=True):
-
+                     write_file=True,
+                     return_waveform=False):
+    """
+    Waveform file name and code. The waveform is read from the waveform store
+    (see stored_waveform), and written to the file if it doesn't exist.
+    With return_waveform=True, the waveform and the filter length are also returned.
+    """
     os.system("mkdir -p waveforms")
     ofname='waveforms/code-l%d-b%d-%06df_%dk.bin' % (clen, oversample, station, int(bandwidth/1e3))
 
-    if code_type=="prn":
-        code=create_pseudo_random_code(clen=clen, seed=station, pulse_length=pulse_length, ipp=ipp)
-    elif code_type=="barker13":
-        code=barker13ipps(clen=clen,ipp=ipp)
-    elif code_type=="barker36":
-        code=barker36(clen=clen,ipp=ipp)
-    else:
-        code=create_prn_dft_code(clen=clen, seed=station)
-        
-    # oversample code
-    a = rep_seq(code,
-                rep=oversample)
-
-    if filter_output:
-        a=filter_waveform(a,
-                          sr=sr,
-                          bandwidth=bandwidth,
-                          max_power_outside_band=power_outside_band)
+    a, code, fl=stored_waveform(station=station,
+                                clen=clen,
+                                oversample=oversample,
+                                filter_output=filter_output,
+                                sr=sr,
+                                bandwidth=bandwidth,
+                                power_outside_band=power_outside_band,
+                                pulse_length=pulse_length,
+                                ipp=ipp,
+                                code_type=code_type)
 
     if write_file:
          if os.path.exists(ofname):
@@ -217,7 +308,8 @@ def waveform_to_file(station=0,
          else:
              a.tofile(ofname)
 
-        
+    if return_waveform:
+        return(ofname, code, a, fl)
     return(ofname, code)
 
 
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Wait for files to appear in a directory.
+
+Uses Linux inotify through ctypes, so that a waiting process wakes up as
+soon as a file is renamed into, or closed after writing in, the
+directory. Falls back to polling if inotify is not available.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+IN_CLOSE_WRITE=0x00000008
+IN_MOVED_TO=0x00000080
+IN_NONBLOCK=0o4000
+IN_CLOEXEC=0o2000000
+
+
+class dir_watch:
+    def __init__(self, path, poll_interval=1.0):
+        self.path=path
+        self.poll_interval=poll_interval
+        self.fd=None
+        try:
+            libc=ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd=libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            wd=libc.inotify_add_watch(fd, path.encode(), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.fd=fd
+        except (OSError, AttributeError, TypeError) as e:
+            print("inotify not available (%s), polling %s every %1.1f s"
+                  % (str(e), path, poll_interval))
+
+    def wait(self, timeout=10.0):
+        """
+        Wait until a file is written to the directory, or until timeout
+        seconds have passed. Returns True if there may be new files.
+        """
+        if self.fd is None:
+            time.sleep(min(timeout, self.poll_interval))
+            return(True)
+        ready, _, _=select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return(False)
+        # we only care that something happened, not what
+        try:
+            while len(os.read(self.fd, 65536)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+        return(True)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd=None
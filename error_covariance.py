@@ -6,6 +6,7 @@
 #
 import numpy as n
 import matplotlib.pyplot as plt
+import scipy.linalg
 import h5py
 import create_waveform
 import prc_lib
@@ -19,12 +20,13 @@ plt.plot(code.real)
 plt.plot(code.imag)
 plt.show()
 
-r=prc_lib.create_estimation_matrix(code, rmin=0, rmax=1000)
+r=prc_lib.periodic_convolution_matrix(code, rmin=0, rmax=1000)
 
 A=r["A"]
 
-# a posteriory covariance matrix
-S=n.linalg.inv(n.dot(n.conj(n.transpose(A)), A))
+# a posteriory covariance matrix (A^H A)^{-1}
+AhA=n.dot(n.conj(n.transpose(A)), A)
+S=scipy.linalg.cho_solve(scipy.linalg.cho_factor(AhA, lower=True), n.eye(AhA.shape[0], dtype=AhA.dtype))
 
 plt.figure(figsize=(10, 6))
 plt.subplot(121)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Process-wide cache of estimation matrices (and other decoding estimators).
+
+Estimators are keyed by a hash of the code and the decoding parameters,
+so that all frequencies of a sweep that use the same code share one
+estimator. The cache has a memory limit, and the least recently used
+estimators are evicted when the limit is exceeded.
+"""
+import collections
+import hashlib
+import threading
+
+import numpy as n
+
+
+def estimator_nbytes(value):
+    """ memory used by an estimator (array, or dict of arrays) """
+    if isinstance(value, dict):
+        return(sum([estimator_nbytes(v) for v in value.values()]))
+    if isinstance(value, n.ndarray):
+        return(value.nbytes)
+    return(0)
+
+
+def code_key(code, n_ranges, rmin=0, kind="dense"):
+    """
+    Cache key for an estimator of a given type, code and range gates
+    """
+    code=n.ascontiguousarray(code)
+    code_hash=hashlib.sha1(code.tobytes()).hexdigest()
+    return((kind, code_hash, str(code.dtype), len(code), int(rmin), int(n_ranges)))
+
+
+class lru_cache:
+    def __init__(self, max_bytes=512e6):
+        self.max_bytes=max_bytes
+        self.entries=collections.OrderedDict()
+        self.n_bytes=0
+        self.hits=0
+        self.misses=0
+        self.lock=threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses+=1
+                return(None)
+            self.hits+=1
+            self.entries.move_to_end(key)
+            return(self.entries[key][0])
+
+    def put(self, key, value):
+        size=estimator_nbytes(value)
+        with self.lock:
+            if key in self.entries:
+                self.n_bytes-=self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                # doesn't fit, don't cache
+                return
+            self.entries[key]=(value, size)
+            self.n_bytes+=size
+            self.evict()
+
+    def evict(self):
+        """ remove least recently used entries until we are within the memory limit """
+        while self.n_bytes > self.max_bytes and len(self.entries) > 0:
+            key, (value, size)=self.entries.popitem(last=False)
+            self.n_bytes-=size
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes=max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes=0
+
+    def __str__(self):
+        return("estimation cache %d entries %1.1f/%1.1f MB hits %d misses %d"
+               % (len(self.entries), self.n_bytes/1e6, self.max_bytes/1e6, self.hits, self.misses))
+
+
+# the cache shared by everything in this process
+cache=lru_cache()
+
+
+def set_max_mb(max_mb):
+    """ set memory limit of the process-wide cache """
+    cache.set_max_bytes(max_mb*1e6)
+
+
+def get(key, create):
+    """
+    Get estimator from cache. If it isn't cached, create it
+    by calling create() and store the result.
+    """
+    value=cache.get(key)
+    if value is None:
+        value=create()
+        cache.put(key, value)
+    return(value)
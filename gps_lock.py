@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import numpy as n
+import threading
 import time
 import uhd
 import stuffr
@@ -7,7 +8,11 @@ import stuffr
 
 def check_lock(u, log=None, exit_if_not_locked=False):
     locked=u.get_mboard_sensor("gps_locked").to_bool()
+    log_lock(locked, log=log, exit_if_not_locked=exit_if_not_locked)
+    return(locked)
+
 
+def log_lock(locked, log=None, exit_if_not_locked=False):
     with open("gps.log", "a") as f:
         f.write("%s lock=%d\n" % (stuffr.unix2datestr(time.time()), locked))
 
@@ -71,28 +76,73 @@ def sync_clock(u, log, min_sync_time=300.0):
 
 
 class gpsdo_monitor:
-    def __init__(self, u, log, holdover_time=1800.0, exit_on_lost_lock=True):
+    def __init__(self, u, log, holdover_time=1800.0, exit_on_lost_lock=True, interval=10.0, lock=None):
+        """
+        Poll the GPS lock of the GPSDO every interval seconds in a background
+        thread, which also writes the telemetry. check() only reads the
+        cached state, so it can be called from the transmit and receive loops.
+        lock is held while talking to the usrp (see timed_scheduler).
+        """
         self.u=u
+        if lock is None:
+            lock=threading.Lock()
+        self.lock=lock
         self.t_last_locked=time.time()
         self.holdover_time=holdover_time
         self.log=log
         self.exit_on_lost_lock=exit_on_lost_lock
-
-    def check(self):
-        locked=check_lock(self.u, log=self.log, exit_if_not_locked=False)
-        locked_on_avg=True
+        self.interval=interval
+        # cached state, updated by the monitor thread
+        self.locked=True
+        self.locked_on_avg=True
+        self.stop_event=threading.Event()
+        self.thread=threading.Thread(target=self.monitor, daemon=True)
+        self.thread.start()
+
+    def poll(self):
+        """ query the GPSDO and update the cached state """
+        try:
+            with self.lock:
+                locked=self.u.get_mboard_sensor("gps_locked").to_bool()
+            log_lock(locked, log=self.log)
+        except Exception as e:
+            self.log.log("Error reading GPS lock (%s)" % (str(e)))
+            return
+        t_now=time.time()
         if not locked:
-            delta_t = time.time()-self.t_last_locked
+            delta_t=t_now-self.t_last_locked
             if delta_t > self.holdover_time:
-                self.log.log("Lost GPS lock for %1.2f seconds. Exiting" % (delta_t))
-                locked_on_avg=False
-                if self.exit_on_lost_lock:
-                    exit(0)
+                self.log.log("Lost GPS lock for %1.2f seconds. Holdover time exceeded" % (delta_t))
+                self.locked_on_avg=False
             else:
                 self.log.log("Lost GPS lock for %1.2f seconds" % (delta_t))
         else:
-            self.t_last_locked=time.time()
-        return(locked_on_avg)
+            self.t_last_locked=t_now
+            self.locked_on_avg=True
+        self.locked=locked
+
+    def monitor(self):
+        while not self.stop_event.is_set():
+            self.poll()
+            self.stop_event.wait(self.interval)
+
+    def holdover(self):
+        """ seconds since the GPS was last locked """
+        return(time.time()-self.t_last_locked)
+
+    def check(self):
+        """
+        False if the GPS lock has been lost for longer than the holdover time.
+        Exits if exit_on_lost_lock is set (the exit happens in the calling thread).
+        """
+        if not self.locked_on_avg and self.exit_on_lost_lock:
+            self.log.log("Lost GPS lock for %1.2f seconds. Exiting" % (self.holdover()))
+            exit(0)
+        return(self.locked_on_avg)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
 
 
 if __name__ == "__main__":
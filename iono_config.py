@@ -60,34 +60,119 @@ class iono_config:
         self.ipps=json.loads(c["config"]["ipp"])
         self.bws=json.loads(c["config"]["bw"])
 
+        # decimate each code further to match its bandwidth, in the receiver
+        # and the analysis (e.g., 50 kHz codes are stored and decoded at 50 kHz)
+        self.adaptive_decimation=bool(json.loads(c["config"].get("adaptive_decimation", "false")))
+
+        # how many frequencies that use the same code are decoded
+        # with one matrix-matrix product
+        self.decode_stack=int(json.loads(c["config"].get("decode_stack", "16")))
+
+        # "dense" uses the precalculated (n_range_gates x code_len) estimation matrix
+        # "fft" uses FFTs and a Toeplitz solve, which needs much less memory
+        # "sparse" only uses the transmitted samples of pulsed codes
+        # "auto" uses sparse for pulsed codes and dense otherwise
+        self.decoder=json.loads(c["config"].get("decoder", '"auto"'))
+        if self.decoder not in ["auto", "dense", "fft", "sparse"]:
+            print("Unknown decoder %s. Exiting." % (self.decoder))
+            exit(0)
+
+        # memory limit for estimation matrices kept in memory by the analysis
+        self.estimation_cache_mb=float(json.loads(c["config"].get("estimation_cache_mb", "512")))
+        # size limit of the estimation matrices and waveforms stored on disk
+        self.estimation_store_mb=float(json.loads(c["config"].get("estimation_store_mb", "2048")))
+        # how many threads are used to build estimation matrices for different codes
+        self.estimator_workers=int(json.loads(c["config"].get("estimator_workers", "4")))
+        # how many processes analyze the frequencies of a sweep in parallel
+        self.analysis_workers=int(json.loads(c["config"].get("analysis_workers", "1")))
+        # how many processes write plots and data files in the background,
+        # and how many plots and files can wait to be written
+        self.output_workers=int(json.loads(c["config"].get("output_workers", "1")))
+        self.output_queue=int(json.loads(c["config"].get("output_queue", "16")))
+        # analysis service decodes each frequency as soon as it has been recorded,
+        # instead of waiting for the whole sweep
+        self.follow=bool(json.loads(c["config"].get("follow", "false")))
+
+        # how the receiver hands raw voltage to the analysis:
+        # "file" writes files to data_dir, "shm" uses a shared memory ring buffer
+        # called shm_name (manifests are written to data_dir in both cases)
+        self.transport=json.loads(c["config"].get("transport", '"file"'))
+        if self.transport not in ["file", "shm"]:
+            print("Unknown transport %s. Exiting." % (self.transport))
+            exit(0)
+        self.shm_name=json.loads(c["config"].get("shm_name", '"ionosonde"'))
+        # how many frequencies the receiver can have waiting to be written,
+        # and how many threads write them
+        self.rx_write_buffers=int(json.loads(c["config"].get("rx_write_buffers", "4")))
+        self.rx_write_workers=int(json.loads(c["config"].get("rx_write_workers", "1")))
+        if self.rx_write_buffers < 1 or self.rx_write_workers < 1:
+            print("rx_write_buffers and rx_write_workers must be at least 1. Exiting.")
+            exit(0)
+        # host sample format of the receiver: "fc32" (complex64, converted by uhd)
+        # or "sc16" (int16 I/Q, converted to float by the decimation filter)
+        self.rx_host_format=json.loads(c["config"].get("rx_host_format", '"fc32"'))
+        if self.rx_host_format not in ["fc32", "sc16"]:
+            print("Unknown rx_host_format %s. Exiting." % (self.rx_host_format))
+            exit(0)
+        # host sample format of the transmitter: code periods are converted
+        # to "sc16" once, or sent as "fc32" and converted by uhd
+        self.tx_host_format=json.loads(c["config"].get("tx_host_format", '"sc16"'))
+        if self.tx_host_format not in ["fc32", "sc16"]:
+            print("Unknown tx_host_format %s. Exiting." % (self.tx_host_format))
+            exit(0)
+        # receiver ingest health counters are appended to this file once per sweep
+        # ("" to disable)
+        self.rx_stats_file=json.loads(c["config"].get("rx_stats_file", '"log/rx-stats.jsonl"'))
+
         if not quiet:
             print("Creating waveforms")
         self.n_codes=len(self.code_types)
         self.codes=[]
         self.orig_codes=[]
+        # transmit waveforms and their filter lengths, from the waveform store
+        self.waveforms=[]
+        self.filter_lens=[]
         for i in range(self.n_codes):
             if self.pulse_lengths[i] > 0:
                 if n.mod(int(self.code_len), int(self.ipps[i])) != 0:
                     print("Code length %d must be a multiple of IPP %d."
                           " This is not the case. Exiting." % (self.code_len, self.ipps[i]))
                     exit(0)
-            # todo. we should avoid dumping the waveforms to files
-            # for all but debugging purposes. the waveforms
-            # created here (ocode) should be directly fed into sweep.
-            cfname, ocode=create_waveform.waveform_to_file(station=self.station_id,
-                                                           clen=self.code_len,
-                                                           oversample=self.dec,
-                                                           filter_output=True,
-                                                           sr=self.sample_rate,
-                                                           bandwidth=self.bws[i],
-                                                           power_outside_band=0.01,
-                                                           pulse_length=self.pulse_lengths[i],
-                                                           ipp=self.ipps[i],
-                                                           code_type=self.code_types[i],
-                                                           write_file=write_waveforms)
+            # waveforms come from the waveform store and are fed directly
+            # into sweep. the waveform files are only needed for debugging.
+            cfname, ocode, wf, fl=create_waveform.waveform_to_file(station=self.station_id,
+                                                                   clen=self.code_len,
+                                                                   oversample=self.dec,
+                                                                   filter_output=True,
+                                                                   sr=self.sample_rate,
+                                                                   bandwidth=self.bws[i],
+                                                                   power_outside_band=0.01,
+                                                                   pulse_length=self.pulse_lengths[i],
+                                                                   ipp=self.ipps[i],
+                                                                   code_type=self.code_types[i],
+                                                                   write_file=write_waveforms,
+                                                                   return_waveform=True)
 
             self.codes.append(cfname)
             self.orig_codes.append(ocode)
+            self.waveforms.append(wf)
+            self.filter_lens.append(fl)
+
+        # extra decimation, code used for decoding, and number of
+        # range gates at the decimated sample rate for each code
+        self.code_decs=[]
+        self.decoding_codes=[]
+        self.code_n_range_gates=[]
+        for i in range(self.n_codes):
+            q=1
+            if self.adaptive_decimation:
+                q=create_waveform.code_decimation(self.bws[i],
+                                                  sr=self.sample_rate/self.dec,
+                                                  clen=self.code_len,
+                                                  ipp=self.ipps[i] if self.pulse_lengths[i] > 0 else -1)
+            self.code_decs.append(q)
+            self.decoding_codes.append(create_waveform.decimate(self.orig_codes[i], q))
+            self.code_n_range_gates.append(int(n.ceil(self.n_range_gates/q)))
 
         self.freqs=json.loads(c["config"]["freqs"])
         self.n_freqs=len(self.freqs)
@@ -145,6 +230,7 @@ class iono_config:
 
         self.s=sweep.sweep(freqs=self.freqs,
                            codes=self.codes,
+                           waveforms=self.waveforms,
                            sample_rate=self.sample_rate,
                            code_amp=self.transmit_amplitude,  # safe setting for waveform amplitude
                            freq_dur=self.frequency_duration)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Content-addressed on-disk store for numpy arrays.
+
+Arrays are stored as raw .npy files, named after a hash of everything
+that was used to calculate them, so a stored array can never be mistaken
+for one calculated with other parameters. Files can be memory mapped
+without copying. Writes go to a temporary file that is atomically renamed,
+so several processes can share the same store.
+
+The store has a size limit. Reading an array marks it as used, and the
+least recently used arrays are removed when the limit is exceeded, so
+arrays of old codes and old key versions don't accumulate.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as n
+
+# size limit of stores that don't set their own
+default_max_bytes=2048e6
+
+
+def set_max_mb(max_mb):
+    """ set the size limit of stores in this process """
+    global default_max_bytes
+    default_max_bytes=max_mb*1e6
+
+
+def hash_key(*parts):
+    """
+    Hash of arrays and parameters. Arrays are hashed by content, shape and
+    data type, everything else by its string representation.
+    """
+    h=hashlib.sha1()
+    for p in parts:
+        if isinstance(p, n.ndarray):
+            p=n.ascontiguousarray(p)
+            h.update(("array %s %s" % (p.dtype, p.shape)).encode())
+            h.update(p.tobytes())
+        else:
+            h.update(("%s %r" % (type(p).__name__, p)).encode())
+        h.update(b"\0")
+    return(h.hexdigest())
+
+
+class npy_store:
+    def __init__(self, path, max_bytes=None):
+        """
+        Store in directory path, with at most max_bytes of arrays
+        (default_max_bytes if None)
+        """
+        self.path=path
+        self.max_bytes=max_bytes
+
+    def fname(self, key, name):
+        return("%s/%s-%s.npy" % (self.path, name, key))
+
+    def exists(self, key, name):
+        return(os.path.exists(self.fname(key, name)))
+
+    def load(self, key, name, mmap=True):
+        """
+        Read array. Returns None if the array is not in the store, or if
+        the file cannot be read.
+        """
+        fname=self.fname(key, name)
+        if not os.path.exists(fname):
+            return(None)
+        try:
+            if mmap:
+                a=n.load(fname, mmap_mode="r")
+            else:
+                a=n.load(fname)
+        except Exception as e:
+            print("unable to read %s (%s)" % (fname, str(e)))
+            return(None)
+        self.touch(fname)
+        return(a)
+
+    def touch(self, fname):
+        """ mark file as recently used """
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+
+    def prune(self, keep=None):
+        """
+        Remove the least recently used arrays until the store is below its
+        size limit. The file keep is never removed. Returns the number of
+        bytes removed.
+        """
+        max_bytes=self.max_bytes
+        if max_bytes is None:
+            max_bytes=default_max_bytes
+        files=[]
+        for f in os.listdir(self.path):
+            if f.endswith(".npy") and not f.startswith(".tmp-"):
+                try:
+                    st=os.stat("%s/%s" % (self.path, f))
+                    files.append((st.st_mtime, st.st_size, "%s/%s" % (self.path, f)))
+                except OSError:
+                    # removed by another process
+                    pass
+        n_bytes=sum([f[1] for f in files])
+        n_removed=0
+        for mtime, size, fname in sorted(files):
+            if n_bytes <= max_bytes:
+                break
+            if fname == keep:
+                continue
+            try:
+                os.remove(fname)
+                n_removed+=size
+            except OSError:
+                pass
+            n_bytes-=size
+        return(n_removed)
+
+    def save(self, key, name, a):
+        """
+        Write array atomically. Readers see either no file
+        or the complete file.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_fname=tempfile.mkstemp(dir=self.path, prefix=".tmp-", suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                n.save(f, a)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_fname, self.fname(key, name))
+        except Exception:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            raise
+        self.prune(keep=self.fname(key, name))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Background output stage of the analysis.
+
+Plots and data products are written by worker processes that read jobs
+from a bounded queue, so that the numerical analysis doesn't wait for
+rendering or the disk. If the queue is full, submitting a job blocks,
+which limits the memory used by pending jobs when the disk is slow.
+
+All files are first written to a temporary name in the same directory
+and then renamed, so that readers never see a partially written file.
+"""
+import contextlib
+import multiprocessing
+import os
+
+
+def tmp_name(fname):
+    """ temporary file name in the same directory, hidden from glob patterns """
+    dname, bname=os.path.split(fname)
+    return(os.path.join(dname, ".tmp-%d-%s" % (os.getpid(), bname)))
+
+
+@contextlib.contextmanager
+def atomic_file(fname):
+    """
+    Yields a temporary file name to write to. The file is renamed to fname
+    when the block finishes, and removed if an exception occurs.
+    """
+    tmp_fname=tmp_name(fname)
+    try:
+        yield tmp_fname
+        os.replace(tmp_fname, fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+
+def atomic_symlink(target, link_name):
+    """ create or replace symbolic link link_name -> target """
+    tmp_link=tmp_name(link_name)
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link_name)
+
+
+def run_job(job):
+    fun, args, kwargs=job
+    try:
+        fun(*args, **kwargs)
+    except Exception as e:
+        print("output job %s failed (%s)" % (fun.__name__, str(e)))
+
+
+def worker(queue):
+    while True:
+        job=queue.get()
+        if job is None:
+            break
+        run_job(job)
+
+
+class output_stage:
+    def __init__(self, n_workers=1, max_queue=16):
+        """
+        n_workers processes execute the jobs. With n_workers=0 jobs are
+        executed immediately in the calling process.
+        Workers are forked, so job functions and their arguments need to
+        be picklable, and functions have to be defined at module level.
+        """
+        self.n_workers=n_workers
+        self.workers=[]
+        if n_workers > 0:
+            ctx=multiprocessing.get_context("fork")
+            self.queue=ctx.Queue(max_queue)
+            for i in range(n_workers):
+                w=ctx.Process(target=worker, args=(self.queue,), daemon=True)
+                w.start()
+                self.workers.append(w)
+
+    def put(self, fun, *args, **kwargs):
+        """
+        Submit job fun(*args, **kwargs). Blocks while the queue is full.
+        Jobs that depend on each other (e.g., a plot and a link to it)
+        should be submitted as one job, as jobs can run in any order.
+        The arguments are sent to the workers in the background, so they
+        must not be modified after submitting.
+        """
+        if self.n_workers == 0:
+            run_job((fun, args, kwargs))
+        else:
+            self.queue.put((fun, args, kwargs))
+
+    def close(self):
+        """ wait until all submitted jobs are done and stop the workers """
+        for w in self.workers:
+            self.queue.put(None)
+        for w in self.workers:
+            w.join()
+        self.workers=[]
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
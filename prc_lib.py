@@ -20,22 +20,25 @@ Coded continuous wave meteor radar, Atmos. Meas. Tech., 9, 829-839,
 doi:10.5194/amt-9-829-2016, 2016.
 
 """
+import concurrent.futures
 import datetime
 import glob
 import itertools
 import math
-import os
 import time
-import h5py
 from argparse import ArgumentParser
 import stuffr
 
 import numpy as np  # this is for those who can't cope with numpy as n
 import numpy as n   # this saves one character of code each time
 import scipy.signal
+import scipy.linalg
 import scipy.fftpack as sf
+import scipy.fft
 
 import create_waveform
+import estimation_cache
+import npy_store
 
 
 def periodic_convolution_matrix(envelope, rmin=0, rmax=100):
@@ -46,123 +49,280 @@ def periodic_convolution_matrix(envelope, rmin=0, rmax=100):
     """
     L = len(envelope)
     ridx = np.arange(rmin, rmax)
-    A = np.zeros([L, rmax-rmin], dtype=np.complex64)
-    for i in np.arange(L):
-        A[i, :] = envelope[(i-ridx) % L]
+    # A[i, r] = envelope[(i-r) % L]
+    A = np.array(envelope[np.mod(np.arange(L)[:, None]-ridx[None, :], L)], dtype=np.complex64)
     result = {}
     result['A'] = A
     result['ridx'] = ridx
     return(result)
 
 
-def create_estimation_matrix(code, rmin=0, rmax=1000):
+def create_estimation_matrix(code, rmin=0, rmax=1000, block_size=100):
+    """
+    B=(A^H A)^{-1}A^H without forming A.
 
-    r_cache = periodic_convolution_matrix(envelope=code, rmin=rmin, rmax=rmax)
-    A = r_cache['A']
-    Ah = np.transpose(np.conjugate(A))
-    # least-squares estimate
-    # B=(A^H A)^{-1}A^H
-    B_cache = np.dot(np.linalg.inv(np.dot(Ah, A)), Ah)
+    For a periodic code, A^H A is a Hermitian Toeplitz matrix given by the
+    autocorrelation function of the code, so it is obtained with FFTs instead
+    of an (n_ranges x clen x n_ranges) matrix product. It is positive definite,
+    so it is inverted with a Cholesky factorization. Each row of B is then the
+    circular convolution of a row of (A^H A)^{-1} with the conjugated code,
+    which is calculated with FFTs, block_size rows at a time.
+    """
+    L = len(code)
+    ridx = np.arange(rmin, rmax)
+    C = np.fft.fft(code)
+    acf = np.fft.ifft(np.abs(C)**2.0)[0:(rmax-rmin)]
+    AhA = scipy.linalg.toeplitz(acf)
+    AhA_inv = scipy.linalg.cho_solve(scipy.linalg.cho_factor(AhA, lower=True),
+                                     np.eye(rmax-rmin, dtype=AhA.dtype))
 
-    r_cache['B'] = B_cache
-    B_cached = True
-    return(r_cache)
+    # B[r, i] = sum_s AhA_inv[r, s] conj(code[(i-ridx[s]) % L])
+    CH = np.fft.fft(np.conj(code))
+    B = np.zeros([rmax-rmin, L], dtype=np.complex64)
+    for r0 in range(0, rmax-rmin, block_size):
+        r1 = min(r0+block_size, rmax-rmin)
+        M = np.zeros([r1-r0, L], dtype=np.complex128)
+        M[:, np.mod(ridx, L)] = AhA_inv[r0:r1, :]
+        B[r0:r1, :] = np.fft.ifft(np.fft.fft(M, axis=1)*CH[None, :], axis=1)
 
+    result = {}
+    result['ridx'] = ridx
+    result['B'] = B
+    return(result)
 
-def analyze_prc2(z,
-                 code,
-                 cache_idx=0,
-                 n_ranges=1000,
-                 rfi_rem=False,
-                 spec_rfi_rem=False,
-                 cache=True,
-                 gc_rem=False,
-                 wfun=scipy.signal.tukey,
-                 gc=20,
-                 fft_filter=False,
-                 time_variable_noise=False,
-                 cw_rem=False):
 
-    an_len=len(z)
-    clen=len(code)
-    N = int(an_len / clen)
-    res = np.zeros([N, n_ranges], dtype=np.complex64)
+def create_fft_estimator(code, rmin=0, rmax=1000):
+    """
+    Least-squares estimator that doesn't need the dense B matrix.
+
+    A^H z is the circular cross-correlation of the measurement with the code,
+    which is calculated with FFTs. A^H A is a Hermitian Toeplitz matrix,
+    which is defined by the first n_ranges lags of the autocorrelation
+    function of the code. Memory use is O(clen + n_ranges).
+    """
+    C=np.fft.fft(code)
+    result = {}
+    result['C'] = np.conj(C)
+    # first column of A^H A
+    result['acf'] = np.fft.ifft(np.abs(C)**2.0)[0:(rmax-rmin)]
+    result['ridx'] = np.arange(rmin, rmax)
+    return(result)
 
-    # use cached version of (A^HA)^{-1}A^H if it exists.
-    cache_file="waveforms/cache-%d.h5" % (cache_idx)
 
-    if os.path.exists(cache_file):
-        with h5py.File(cache_file, "r") as hb:
-            B=np.copy(hb["B"][()])
-    else:
-        r = create_estimation_matrix(code=code, rmax=n_ranges)
+def create_sparse_estimator(code, rmin=0, rmax=1000):
+    """
+    Least-squares estimator for pulsed codes, where most code samples are zero.
+
+    A^H z is summed over the non-zero code samples only, so the cost is
+    proportional to the number of transmitted samples. A^H A is the Hermitian
+    Toeplitz matrix defined by the code autocorrelation, and it is factored
+    once with Cholesky.
+    """
+    C=np.fft.fft(code)
+    acf=np.fft.ifft(np.abs(C)**2.0)[0:(rmax-rmin)]
+    nz=np.where(code != 0)[0]
+    result = {}
+    result['nz'] = nz
+    result['c'] = np.array(np.conj(code[nz]), dtype=np.complex64)
+    result['AhA_L'] = scipy.linalg.cho_factor(scipy.linalg.toeplitz(acf), lower=True)[0]
+    result['ridx'] = np.arange(rmin, rmax)
+    return(result)
+
+
+def select_decoder(code, max_density=0.05):
+    """
+    Use the sparse decoder for pulsed codes where at most max_density
+    of the code samples are non-zero, and the dense decoder otherwise.
+    """
+    if np.sum(code != 0) <= max_density*len(code):
+        return("sparse")
+    return("dense")
+
+
+def estimation_matrix(code, n_ranges=1000, rmin=0, cache_dir="waveforms/cache"):
+    """
+    B=(A^H A)^{-1}A^H for a code.
+
+    B is stored in cache_dir under a hash of the code samples and the range
+    gates, and is memory mapped from there without copying when needed again.
+    Matrices calculated with other codes or decoding parameters are never used.
+    """
+    store=npy_store.npy_store(cache_dir)
+    # change the version string if create_estimation_matrix changes
+    key=npy_store.hash_key("B-v2", np.asarray(code), rmin, n_ranges)
+    B=store.load(key, "B")
+    if B is None:
+        r = create_estimation_matrix(code=code, rmin=rmin, rmax=n_ranges)
         B = r['B']
-        with h5py.File(cache_file, "w") as hb:
-            hb["B"]=B
+        store.save(key, "B", B)
+    return(B)
 
-    spec = np.zeros([N, n_ranges], dtype=np.complex64)
 
-    z.shape=(N, clen)
+def prefilter_prc(z,
+                  clen,
+                  rfi_rem=False,
+                  fft_filter=False,
+                  cw_rem=False):
+    """
+    Reshape the measurement into one code period per row and apply
+    the optional filters that operate on raw voltage.
+    Returns an (N, clen) matrix.
+    """
+    N = int(len(z) / clen)
+    z = np.reshape(z, (N, clen))
 
     if cw_rem:
-        for ri in np.arange(clen):
-            z[:, ri]=z[:, ri]-np.mean(z[1:(N-1), ri])
+        # average over contiguous rows to sum in the same order as a per-gate mean
+        z=z-np.mean(np.ascontiguousarray(np.transpose(z[1:(N-1), :])), axis=1)
 
     if rfi_rem:
         bg=np.median(z, axis=0)
         z=z-bg
 
     if fft_filter:
-        S=np.zeros(clen, dtype=np.float32)
-        for i in np.arange(N):
-            S+=np.abs(sf.fft(z[i, :]))**2.0
-        S=np.sqrt(S/float(N))
-    for i in np.arange(N):
-        # B=(A^H A)^{-1}A^H
-        # B*z = (A^H A)^{-1}A^H*z = x_ml
-        # z = measurement
-        # res[i,:] = backscattered echo complex amplitude
-        if fft_filter:
-            zw=np.array(sf.ifft(sf.fft(z[i, :])/S), dtype=np.complex64)
+        Z=sf.fft(z, axis=1)
+        S=np.sqrt(np.sum(np.abs(Z)**2.0, axis=0, dtype=np.float32)/float(N))
+        z=np.array(sf.ifft(Z/S, axis=1), dtype=np.complex64)
+    return(z)
+
+
+def decode_prc(zw, B):
+    """
+    Decode all code periods with one matrix-matrix product.
+
+    B=(A^H A)^{-1}A^H
+    B*z = (A^H A)^{-1}A^H*z = x_ml
+    zw = measurement, one code period per row
+    res[i,:] = backscattered echo complex amplitude for code period i
+    """
+    return(np.dot(zw, B.T))
+
+
+def decode_prc_fft(zw, est):
+    """
+    Decode all code periods using the FFT estimator.
+
+    x_ml = (A^H A)^{-1}A^H z, where A^H z is calculated with FFTs and
+    the Toeplitz system is solved with the Levinson recursion.
+    """
+    Ahz=np.fft.ifft(np.fft.fft(zw, axis=1)*est['C'], axis=1)[:, est['ridx']]
+    x=scipy.linalg.solve_toeplitz(est['acf'], np.transpose(Ahz))
+    return(np.array(np.transpose(x), dtype=np.complex64))
+
+
+def decode_prc_sparse(zw, est):
+    """
+    Decode all code periods using the sparse estimator.
+
+    A^H z[r] = sum_j conj(code[j]) z[(j+r) % clen] over non-zero code
+    samples j, followed by a Cholesky solve with A^H A.
+    """
+    N, L = zw.shape
+    ridx=est['ridx']
+    R=len(ridx)
+    # periodic extension, so that shifted windows don't wrap around
+    zz=np.concatenate((zw, zw[:, 0:(ridx[-1]+1)]), axis=1)
+    Ahz=np.zeros([N, R], dtype=np.complex64)
+    for j, cj in zip(est['nz']+ridx[0], est['c']):
+        Ahz+=cj*zz[:, j:(j+R)]
+    x=scipy.linalg.cho_solve((est['AhA_L'], True), np.transpose(Ahz))
+    return(np.array(np.transpose(x), dtype=np.complex64))
+
+
+def create_decoder(code, decoder="dense", n_ranges=1000, cache_dir="waveforms/cache"):
+    """
+    Estimator used to decode code periods.
+
+    decoder="dense" uses the (n_ranges x clen) matrix B=(A^H A)^{-1}A^H
+    decoder="fft" uses FFTs and a Toeplitz solve, and never forms B
+    decoder="sparse" only uses the non-zero samples of a pulsed code
+    decoder="auto" selects sparse for pulsed codes and dense otherwise
+
+    Estimators are kept in the process-wide estimation_cache, so each
+    distinct code is read or calculated at most once.
+    """
+    if decoder == "auto":
+        decoder=select_decoder(code)
+
+    def create():
+        if decoder == "dense":
+            est={'B': estimation_matrix(code, n_ranges=n_ranges, cache_dir=cache_dir)}
+        elif decoder == "fft":
+            est=create_fft_estimator(code, rmax=n_ranges)
+        elif decoder == "sparse":
+            est=create_sparse_estimator(code, rmax=n_ranges)
         else:
-            zw=z[i, :]
-        res[i, :] = np.dot(B, zw)
+            raise ValueError("Unknown decoder %s" % (decoder))
+        est['decoder']=decoder
+        return(est)
+
+    return(estimation_cache.get(estimation_cache.code_key(code, n_ranges, kind=decoder), create))
+
+
+def precompute_decoders(codes, decoder="dense", n_ranges=1000, cache_dir="waveforms/cache", n_workers=4):
+    """
+    Create estimators for several codes in parallel and store them in the
+    estimation cache. FFTs and linear algebra release the GIL, so threads
+    are sufficient. n_ranges can also be a list, with one value per code.
+    """
+    if not isinstance(n_ranges, (list, tuple)):
+        n_ranges=[n_ranges]*len(codes)
+
+    def create(code, code_n_ranges):
+        return(create_decoder(code, decoder=decoder, n_ranges=code_n_ranges, cache_dir=cache_dir))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, n_workers)) as ex:
+        return(list(ex.map(create, codes, n_ranges)))
+
+
+def apply_decoder(zw, est):
+    """
+    Decode code periods (one per row of zw) with an estimator
+    from create_decoder.
+    """
+    if est['decoder'] == "fft":
+        return(decode_prc_fft(zw, est))
+    if est['decoder'] == "sparse":
+        return(decode_prc_sparse(zw, est))
+    return(decode_prc(zw, est['B']))
+
+
+def postprocess_prc(res,
+                    spec_rfi_rem=False,
+                    gc_rem=False,
+                    gc=20,
+                    time_variable_noise=False):
+    """
+    Range-Doppler spectrum and noise normalization of decoded echoes.
+    """
+    N, n_ranges = res.shape
 
     if gc_rem:
-        for i in range(gc, n_ranges):
-            res[:, i]=res[:, i]-np.median(res[:, i])
+        res[:, gc:]=res[:, gc:]-np.median(res[:, gc:], axis=0)
 
     if time_variable_noise:
-        for i in np.arange(N):
-            noise_amp=np.median(np.abs(res[i, :]))
-            res[i, :]=res[i, :]/noise_amp
+        noise_amp=np.median(np.abs(res), axis=1)
+        res[:, :]=res/noise_amp[:, None]
 
     window=1.0  # wfun(N)
     # ignore first and last, where frequency transition occurs
     res[0, :]=0.0
     res[N-1, :]=0.0
-    for i in np.arange(n_ranges):
-        spec[:, i] = np.fft.fftshift(np.fft.fft(
-            window * res[:, i]
-        ))
-
-    spec_snr=np.zeros(spec.shape, dtype=np.float32)
+    # doppler spectrum for all range gates
+    spec = np.array(np.fft.fftshift(np.fft.fft(window * res, axis=0), axes=0), dtype=np.complex64)
 
     if spec_rfi_rem:
-        median_spec = np.zeros(N, dtype=np.complex64)
-        noise_floor = np.zeros(N, dtype=np.float32)
-        spec_std = np.zeros(N, dtype=np.float32)
-
-        for i in np.arange(N):
-            median_spec[i] = np.median(spec[i, :])
-            noise_floor[i] = np.median(np.abs(spec[i, :])**2.0)
-            spec_std[i] = np.median(np.abs(spec[i, :]-median_spec[i]))
+        median_spec = np.array(np.median(spec, axis=1), dtype=np.complex64)
+        noise_floor = np.array(np.median(np.abs(spec)**2.0, axis=1), dtype=np.float32)
+        spec_std = np.array(np.median(np.abs(spec-median_spec[:, None]), axis=1), dtype=np.float32)
 
-        for i in np.arange(n_ranges):
-            # signal to noise ratio, frequency dependent
-            spec_snr[:, i]= (np.abs(spec[:, i])**2.0-noise_floor)/noise_floor
-            # noise standard deviation normalized power.
-            spec[:, i] = (spec[:, i]-median_spec)/spec_std
+        # signal to noise ratio, frequency dependent
+        spec_snr = np.array((np.abs(spec)**2.0-noise_floor[:, None])/noise_floor[:, None],
+                            dtype=np.float32)
+        # noise standard deviation normalized power.
+        spec = np.array((spec-median_spec[:, None])/spec_std[:, None], dtype=np.complex64)
+    else:
+        spec_snr=np.zeros(spec.shape, dtype=np.float32)
 
     spec_snr[spec_snr < 0]=1e-3
     ret = {}
@@ -170,3 +330,124 @@ def analyze_prc2(z,
     ret['spec'] = spec
     ret['spec_snr'] = spec_snr
     return(ret)
+
+
+def spectral_filter_pulse(z, ipp=500, pulse_len=10, guard=None, n_avg=100):
+    """
+    Whitening filter that suppresses narrow band interference, such as
+    broadcast stations, in pulsed measurements.
+
+    The interference power spectrum is estimated with one batched FFT of
+    at most n_avg IPPs spread over the measurement, leaving out the transmit
+    pulse at the start of each IPP. Frequency bins above the median noise
+    level are attenuated down to the noise level. The gain has one value per
+    IPP frequency bin, so it is applied as an ipp tap FIR filter with
+    overlap-save, using short batched FFTs instead of FFTs of the whole
+    measurement.
+
+    The cost is one forward and one inverse FFT pass over all samples,
+    about a third of the time of the sparse decoder, which only touches
+    each sample a few times. This cost is accepted: a shorter filter or
+    other FFT block sizes save at most about 20%, and the filter can't be
+    reused across frequencies, because the interference differs.
+    """
+    if guard is None:
+        guard=pulse_len
+    N=len(z)
+    n_ipp=int(N/ipp)
+    zi=np.reshape(z[0:(n_ipp*ipp)], (n_ipp, ipp))
+    if n_ipp > n_avg:
+        zi=zi[np.linspace(0, n_ipp-1, num=n_avg).astype(int), :]
+
+    # leave out the transmit pulse, which would otherwise dominate
+    w=np.ones(ipp, dtype=np.float32)
+    w[0:min(ipp, pulse_len+guard)]=0.0
+    S=np.mean(np.abs(scipy.fft.fft(zi*w[None, :], axis=1))**2.0, axis=0)
+    noise_floor=np.median(S)
+
+    # don't amplify anything, only attenuate bins above the noise floor
+    gain=np.ones(ipp, dtype=np.float32)
+    rfi=S > noise_floor
+    gain[rfi]=np.sqrt(noise_floor/S[rfi])
+
+    # impulse response centered at ipp/2, tapered to reduce ripple
+    h=np.array(np.fft.fftshift(np.fft.ifft(gain))*np.hanning(ipp+1)[0:ipp], dtype=np.complex64)
+
+    # overlap-save: blocks of M samples that overlap by ipp-1 samples
+    M=int(2**np.ceil(np.log2(4*ipp)))
+    step=M-ipp+1
+    n_blocks=int(np.ceil((N+ipp/2)/float(step)))
+    x=np.zeros(n_blocks*step+ipp-1, dtype=np.complex64)
+    x[(ipp-1):(ipp-1+N)]=z
+    blocks=np.lib.stride_tricks.sliding_window_view(x, M)[::step, :]
+    H=np.array(scipy.fft.fft(h, M), dtype=np.complex64)
+    y=scipy.fft.ifft(scipy.fft.fft(blocks, axis=1)*H[None, :], axis=1)[:, (ipp-1):]
+    # remove the delay of the filter (fftshift centers h at sample ipp//2)
+    s=int(ipp//2)
+    return(np.array(np.reshape(y, -1)[s:(s+N)], dtype=np.complex64))
+
+
+def analyze_prc2(z,
+                 code,
+                 n_ranges=1000,
+                 rfi_rem=False,
+                 spec_rfi_rem=False,
+                 cache=True,
+                 gc_rem=False,
+                 wfun=scipy.signal.tukey,
+                 gc=20,
+                 fft_filter=False,
+                 time_variable_noise=False,
+                 cw_rem=False,
+                 decoder="dense",
+                      cache_dir="waveforms/cache"):
+
+    clen=len(code)
+    est=create_decoder(code, decoder=decoder, n_ranges=n_ranges, cache_dir=cache_dir)
+
+    zw=prefilter_prc(z, clen, rfi_rem=rfi_rem, fft_filter=fft_filter, cw_rem=cw_rem)
+    res=apply_decoder(zw, est)
+
+    return(postprocess_prc(res,
+                           spec_rfi_rem=spec_rfi_rem,
+                           gc_rem=gc_rem,
+                           gc=gc,
+                           time_variable_noise=time_variable_noise))
+
+
+def analyze_prc_stack(zs,
+                      code,
+                      n_ranges=1000,
+                      rfi_rem=False,
+                      spec_rfi_rem=False,
+                      gc_rem=False,
+                      gc=20,
+                      fft_filter=False,
+                      time_variable_noise=False,
+                      cw_rem=False,
+                      decoder="dense",
+                      cache_dir="waveforms/cache"):
+    """
+    Same as analyze_prc2, but for a list of measurements (e.g., several
+    frequencies of a sweep) that use the same code. The code periods of all
+    measurements are stacked and decoded with one matrix-matrix product.
+    Returns a list of results, one for each measurement.
+    """
+    clen=len(code)
+    est=create_decoder(code, decoder=decoder, n_ranges=n_ranges, cache_dir=cache_dir)
+
+    zws=[prefilter_prc(z, clen, rfi_rem=rfi_rem, fft_filter=fft_filter, cw_rem=cw_rem)
+         for z in zs]
+    res_all=apply_decoder(np.concatenate(zws, axis=0), est)
+
+    rets=[]
+    i0=0
+    for zw in zws:
+        N=zw.shape[0]
+        rets.append(postprocess_prc(res_all[i0:(i0+N), :],
+                                    spec_rfi_rem=spec_rfi_rem,
+                                    gc_rem=gc_rem,
+                                    gc=gc,
+                                    time_variable_noise=time_variable_noise))
+        i0+=N
+    return(rets)
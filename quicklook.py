@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Fast quicklook plots without matplotlib.
+
+Images are drawn with colors from a 256 color palette: a colormap lookup
+table, white and black. Arrays in dB are mapped directly to palette
+indices, and the image is written as an indexed color PNG file with
+zlib. Axes, ticks and text are drawn with a small bitmap font. This is much faster than matplotlib, and good enough
+for the quicklook plots that are made for every frequency of every sweep.
+"""
+import struct
+import zlib
+
+import numpy as n
+
+# viridis colormap (matplotlib) in 33 steps, interpolated to the lookup table
+VIRIDIS_33=[[68, 1, 84], [71, 13, 96], [72, 24, 106], [72, 35, 116], [71, 45, 123],
+            [69, 55, 129], [66, 64, 134], [62, 73, 137], [59, 82, 139], [55, 91, 141],
+            [51, 99, 141], [47, 107, 142], [44, 114, 142], [41, 122, 142], [38, 130, 142],
+            [35, 137, 142], [33, 145, 140], [31, 152, 139], [31, 160, 136], [34, 167, 133],
+            [40, 174, 128], [50, 182, 122], [63, 188, 115], [78, 195, 107], [94, 201, 98],
+            [112, 207, 87], [132, 212, 75], [152, 216, 62], [173, 220, 48], [194, 223, 35],
+            [216, 226, 25], [236, 229, 27], [253, 231, 37]]
+
+# 5x7 pixel font. Each character is seven rows, each row two hex digits
+# with the leftmost pixel in bit 4. Text is drawn in upper case.
+FONT={" ":"00000000000000", "A":"0e11111f111111", "B":"1e11111e11111e", "C":"0e11101010110e",
+      "D":"1e11111111111e", "E":"1f10101e10101f", "F":"1f10101e101010", "G":"0e11101711110f",
+      "H":"1111111f111111", "I":"0e04040404040e", "J":"0702020202120c", "K":"11121418141211",
+      "L":"1010101010101f", "M":"111b1515111111", "N":"11111915131111", "O":"0e11111111110e",
+      "P":"1e11111e101010", "Q":"0e11111115120d", "R":"1e11111e141211", "S":"0f10100e01011e",
+      "T":"1f040404040404", "U":"1111111111110e", "V":"11111111110a04", "W":"1111111515150a",
+      "X":"11110a040a1111", "Y":"11110a04040404", "Z":"1f01020408101f", "0":"0e11131519110e",
+      "1":"040c040404040e", "2":"0e11010204081f", "3":"1f02040201110e", "4":"02060a121f0202",
+      "5":"1f101e0101110e", "6":"0608101e11110e", "7":"1f010204080808", "8":"0e11110e11110e",
+      "9":"0e11110f01020c", ".":"00000000000c0c", ",":"000000000c0408", ":":"000c0c000c0c00",
+      "-":"0000001f000000", "+":"0004041f040400", "=":"00001f001f0000", "_":"0000000000001f",
+      "(":"02040808080402", ")":"08040202020408", "[":"0e08080808080e", "]":"0e02020202020e",
+      "/":"00010204081000", "%":"18190204081303", "'":"04040000000000", "<":"02040810080402",
+      ">":"08040201020408", "!":"04040404040004", "?":"0e110102040004", "*":"0004150e150400",
+      "#":"0a0a1f0a1f0a0a"}
+
+# the palette is N_COLORS colormap colors, followed by white and black
+N_COLORS=254
+WHITE=254
+BLACK=255
+
+
+def make_lut(table=VIRIDIS_33, n_colors=N_COLORS):
+    """ colormap lookup table (n_colors x 3, uint8) """
+    table=n.array(table, dtype=n.float64)
+    t=n.linspace(0, 1, num=n_colors)
+    k=n.linspace(0, 1, num=table.shape[0])
+    lut=n.zeros([n_colors, 3], dtype=n.uint8)
+    for ci in range(3):
+        lut[:, ci]=n.round(n.interp(t, k, table[:, ci]))
+    return(lut)
+
+
+VIRIDIS=make_lut()
+PALETTE=n.concatenate((VIRIDIS, [[255, 255, 255], [0, 0, 0]])).astype(n.uint8)
+
+glyph_cache={}
+
+
+def glyph(ch, scale=2):
+    """ bitmap of one character (7*scale x 5*scale) """
+    if (ch, scale) not in glyph_cache:
+        rows=FONT.get(ch, FONT["?"])
+        g=n.zeros([7, 5], dtype=bool)
+        for ri in range(7):
+            bits=int(rows[(2*ri):(2*ri+2)], 16)
+            for ci in range(5):
+                g[ri, ci]=(bits >> (4-ci)) & 1
+        glyph_cache[(ch, scale)]=n.repeat(n.repeat(g, scale, axis=0), scale, axis=1)
+    return(glyph_cache[(ch, scale)])
+
+
+def text_mask(s, scale=2):
+    """ bitmap of a line of text """
+    s=s.upper()
+    mask=n.zeros([7*scale, max(1, 6*scale*len(s)-scale)], dtype=bool)
+    for i, ch in enumerate(s):
+        mask[:, (6*scale*i):(6*scale*i+5*scale)]=glyph(ch, scale)
+    return(mask)
+
+
+def nice_ticks(lo, hi, n_ticks=6):
+    """ round numbers between lo and hi, approximately n_ticks of them """
+    if hi <= lo:
+        return(n.array([lo]))
+    step=(hi-lo)/float(n_ticks)
+    mag=10.0**n.floor(n.log10(step))
+    for m in [1.0, 2.0, 5.0, 10.0]:
+        if m*mag >= step:
+            step=m*mag
+            break
+    ticks=n.arange(n.ceil(lo/step)*step, hi+step*1e-6, step)
+    # +0.0 turns -0 into 0
+    return(n.round(ticks, 10)+0.0)
+
+
+def edges(x, n_cells):
+    """ cell edges from cell edges (n_cells+1) or cell centers (n_cells) """
+    x=n.asarray(x, dtype=n.float64)
+    if len(x) == n_cells+1:
+        return(x)
+    if n_cells == 1:
+        return(n.array([x[0]-0.5, x[0]+0.5]))
+    mid=(x[1:]+x[:-1])/2.0
+    return(n.concatenate(([x[0]-(mid[0]-x[0])], mid, [x[-1]+(x[-1]-mid[-1])])))
+
+
+def image(a, x, y, xlim, ylim, width, height, vmin, vmax, background=WHITE):
+    """
+    Map a (len(y) x len(x)) array onto a width x height image with
+    x from xlim[0] to xlim[1] left to right, and y from ylim[0] to ylim[1]
+    bottom to top, like pcolormesh. x and y are cell edges or cell centers.
+    Returns palette indices. Pixels outside the data, and NaN values,
+    are drawn with the background color.
+    """
+    a=n.asarray(a)
+    n_y, n_x=a.shape
+    x=edges(x, n_x)
+    y=edges(y, n_y)
+
+    # color of each cell, with an extra row and column for the background
+    ci=n.full([n_y+1, n_x+1], background, dtype=n.uint8)
+    with n.errstate(invalid="ignore"):
+        v=n.clip((a-vmin)/float(vmax-vmin), 0.0, 1.0)*(N_COLORS-1)
+    ci[:n_y, :n_x]=n.where(n.isnan(v), background, n.round(n.nan_to_num(v)))
+
+    # cell containing the center of each pixel
+    xp=xlim[0]+(n.arange(width)+0.5)/width*(xlim[1]-xlim[0])
+    yp=ylim[1]-(n.arange(height)+0.5)/height*(ylim[1]-ylim[0])
+    ix=n.searchsorted(x, xp, side="right")-1
+    iy=n.searchsorted(y, yp, side="right")-1
+    ix[(ix < 0) | (ix >= n_x)]=n_x
+    iy[(iy < 0) | (iy >= n_y)]=n_y
+    return(ci.take(iy, axis=0).take(ix, axis=1))
+
+
+def write_png(fname, rows, width, height, palette=PALETTE, level=1):
+    """
+    Write indexed color PNG file. rows is (height x width+1) uint8:
+    a zero (no filter) followed by the palette indices of each row.
+    """
+    def chunk(tag, data):
+        return(struct.pack(">I", len(data))+tag+data+struct.pack(">I", zlib.crc32(tag+data) & 0xffffffff))
+
+    with open(fname, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)))
+        f.write(chunk(b"PLTE", palette.tobytes()))
+        f.write(chunk(b"IDAT", zlib.compress(rows, level)))
+        f.write(chunk(b"IEND", b""))
+
+
+class canvas:
+    def __init__(self, width, height, background=WHITE):
+        self.width=width
+        self.height=height
+        # PNG rows: filter type byte (zero) followed by the pixels
+        self.rows=n.full([height, width+1], background, dtype=n.uint8)
+        self.rows[:, 0]=0
+        self.pix=self.rows[:, 1:]
+
+    def paint(self, x0, y0, mask, color=BLACK):
+        """ paint pixels of bitmap mask with top left corner at x0, y0 """
+        h, w=mask.shape
+        x1=min(x0+w, self.width)
+        y1=min(y0+h, self.height)
+        mx=max(0, -x0)
+        my=max(0, -y0)
+        if x1 <= x0+mx or y1 <= y0+my:
+            return
+        self.pix[(y0+my):y1, (x0+mx):x1][mask[my:(y1-y0), mx:(x1-x0)]]=color
+
+    def text(self, x, y, s, scale=2, color=BLACK, align="left", vertical=False):
+        """
+        Draw text. x, y is the top left, top center or top right corner
+        depending on align. Lines are separated by newlines.
+        Vertical text is rotated to read bottom to top, and centered at x, y.
+        """
+        for li, line in enumerate(s.split("\n")):
+            mask=text_mask(line, scale)
+            if vertical:
+                mask=n.rot90(mask)
+                self.paint(int(x-mask.shape[1]/2)+li*10*scale, int(y-mask.shape[0]/2), mask, color)
+                continue
+            x0=x
+            if align == "center":
+                x0=int(x-mask.shape[1]/2)
+            elif align == "right":
+                x0=x-mask.shape[1]
+            self.paint(x0, y+li*10*scale, mask, color)
+
+    def rect(self, x0, y0, x1, y1, color=BLACK):
+        """ filled rectangle """
+        self.pix[max(0, y0):max(0, y1), max(0, x0):max(0, x1)]=color
+
+    def frame(self, x0, y0, x1, y1, color=BLACK):
+        """ rectangle outline around x0 <= x < x1, y0 <= y < y1 """
+        self.rect(x0-1, y0-1, x1+1, y0, color)
+        self.rect(x0-1, y1, x1+1, y1+1, color)
+        self.rect(x0-1, y0-1, x0, y1+1, color)
+        self.rect(x1, y0-1, x1+1, y1+1, color)
+
+    def pcolor(self, x0, y0, width, height, a, x, y, xlim, ylim, vmin, vmax,
+               title="", xlabel="", ylabel=""):
+        """
+        Panel with an image of array a (see image()), axes, tick labels and title.
+        x0, y0 is the top left corner of the image area.
+        """
+        self.pix[y0:(y0+height), x0:(x0+width)]=image(a, x, y, xlim, ylim, width, height, vmin, vmax)
+        self.frame(x0, y0, x0+width, y0+height)
+
+        for t in nice_ticks(xlim[0], xlim[1]):
+            px=x0+int(round((t-xlim[0])/(xlim[1]-xlim[0])*(width-1)))
+            self.rect(px, y0+height, px+1, y0+height+6)
+            self.text(px, y0+height+9, "%g" % (t), align="center")
+        for t in nice_ticks(ylim[0], ylim[1]):
+            py=y0+height-1-int(round((t-ylim[0])/(ylim[1]-ylim[0])*(height-1)))
+            self.rect(x0-6, py, x0, py+1)
+            self.text(x0-9, py-7, "%g" % (t), align="right")
+
+        self.text(x0+int(width/2), y0+height+34, xlabel, align="center")
+        self.text(x0-75, y0+int(height/2), ylabel, vertical=True)
+        n_lines=len(title.split("\n"))
+        self.text(x0+int(width/2), y0-20*n_lines-6, title, align="center")
+
+    def colorbar(self, x0, y0, width, height, vmin, vmax, label=""):
+        """ vertical colorbar with top left corner at x0, y0 """
+        ci=n.round(n.linspace(N_COLORS-1, 0, num=height)).astype(n.uint8)
+        self.pix[y0:(y0+height), x0:(x0+width)]=ci[:, None]
+        self.frame(x0, y0, x0+width, y0+height)
+        for t in nice_ticks(vmin, vmax):
+            py=y0+height-1-int(round((t-vmin)/(vmax-vmin)*(height-1)))
+            self.rect(x0+width, py, x0+width+6, py+1)
+            self.text(x0+width+9, py-7, "%g" % (t))
+        self.text(x0+width+62, y0+int(height/2), label, vertical=True)
+
+    def save(self, fname):
+        write_png(fname, self.rows, self.width, self.height)
+
+
+def range_time_doppler(fname, plot, vmin, vmax, ylim):
+    """
+    Quicklook plot of one frequency: range-time power on the left
+    and range-Doppler power on the right (see
+    analyze_ionograms.frequency_products for the contents of plot).
+    """
+    cv=canvas(1280, 720)
+    panel_h=570
+    xlim=[plot["p_tvec"][0], plot["p_tvec"][-1]]
+    cv.pcolor(100, 70, 470, panel_h, plot["dBr"], plot["p_tvec"], plot["p_rvec"], xlim, ylim, vmin, vmax,
+              title=plot["title_r"], xlabel="Time (s)", ylabel="Range (km)")
+    fedges=edges(plot["fvec"], len(plot["fvec"]))
+    xlim=[fedges[0], fedges[-1]]
+    cv.pcolor(690, 70, 470, panel_h, plot["dBs"], fedges, plot["rvec"], xlim, ylim, vmin, vmax,
+              title=plot["title_s"], xlabel="Frequency (Hz)", ylabel="Virtual range (km)")
+    cv.colorbar(1180, 70, 20, panel_h, vmin, vmax, label="SNR (dB)")
+    cv.save(fname)
+
+
+def ionogram(fname, dB, fvec, rvec, vmin, vmax, xlim, ylim, title=""):
+    """
+    Quicklook plot of an ionogram (range gates x frequencies)
+    """
+    cv=canvas(1280, 720)
+    cv.pcolor(100, 70, 1000, 570, dB, fvec, rvec, xlim, ylim, vmin, vmax,
+              title=title, xlabel="Frequency (MHz)", ylabel="Virtual range (km)")
+    cv.colorbar(1120, 70, 20, 570, vmin, vmax, label="SNR (dB)")
+    cv.save(fname)
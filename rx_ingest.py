@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Receive ring buffer. Samples received from the USRP are written into a
+preallocated ring with at most two slice copies per receive call, and
+blocks of samples (e.g., one frequency of a sweep) are handed out as
+views of the ring, without copying unless the block wraps around the
+end of the ring.
+
+Sample positions are absolute sample indices (samples since 1970), so
+that gaps in the received stream are filled with zeros, and the
+position of each block doesn't depend on how many samples were received.
+"""
+import numpy as n
+
+
+class ring_ingest:
+    def __init__(self, ring_len, samples0, dtype=n.complex64):
+        """
+        ring_len samples, starting at absolute sample index samples0
+        """
+        self.ring=n.zeros(ring_len, dtype=dtype)
+        self.ring_len=ring_len
+        self.samples0=samples0
+        # absolute index of the next sample that we expect
+        self.next_sample=samples0
+        # buffer for blocks that wrap around the end of the ring
+        self.wrap_buffer=None
+
+    def write(self, idx, z):
+        """ write z at absolute sample index idx, with at most two slice copies """
+        pos=(idx-self.samples0) % self.ring_len
+        n1=min(len(z), self.ring_len-pos)
+        self.ring[pos:(pos+n1)]=z[:n1]
+        if n1 < len(z):
+            self.ring[:(len(z)-n1)]=z[n1:]
+
+    def zero(self, idx, n_samples):
+        """ fill n_samples starting at absolute sample index idx with zeros """
+        n_samples=min(n_samples, self.ring_len)
+        pos=(idx-self.samples0) % self.ring_len
+        n1=min(n_samples, self.ring_len-pos)
+        self.ring[pos:(pos+n1)]=0
+        if n1 < n_samples:
+            self.ring[:(n_samples-n1)]=0
+
+    def push(self, idx, z):
+        """
+        Add samples z, which start at absolute sample index idx.
+        Returns the number of missing samples before z (positive),
+        or the number of samples that overlap with samples already
+        received, which are ignored (negative).
+        """
+        gap=idx-self.next_sample
+        if gap > 0:
+            self.zero(self.next_sample, gap)
+        elif gap < 0:
+            z=z[min(-gap, len(z)):]
+            idx=self.next_sample
+        if len(z) > self.ring_len:
+            # only the newest samples fit
+            idx+=len(z)-self.ring_len
+            z=z[(len(z)-self.ring_len):]
+        self.write(idx, z)
+        self.next_sample=max(self.next_sample, idx+len(z))
+        return(gap)
+
+    def ready(self, start, n_samples):
+        """ True if all samples of block start...start+n_samples have been received """
+        return(self.next_sample >= start+n_samples)
+
+    def block(self, start, n_samples):
+        """
+        Samples start...start+n_samples. A view of the ring, which is only
+        valid until the ring has been overwritten, or a copy if the block
+        wraps around the end of the ring.
+        """
+        if start < self.next_sample-self.ring_len or n_samples > self.ring_len:
+            raise ValueError("block %d+%d is no longer in the ring" % (start, n_samples))
+        pos=(start-self.samples0) % self.ring_len
+        if pos+n_samples <= self.ring_len:
+            return(self.ring[pos:(pos+n_samples)])
+        if self.wrap_buffer is None or len(self.wrap_buffer) != n_samples:
+            self.wrap_buffer=n.zeros(n_samples, dtype=self.ring.dtype)
+        n1=self.ring_len-pos
+        self.wrap_buffer[:n1]=self.ring[pos:]
+        self.wrap_buffer[n1:]=self.ring[:(n_samples-n1)]
+        return(self.wrap_buffer)
+
+
+class fir_decimator:
+    def __init__(self, w, dec, samples0, max_chunk, sc16=False):
+        """
+        Streaming FIR low pass filter and decimator. Output sample k is
+
+          y[k] = sum_j w[j] x[samples0 + k*dec + len(w)/2 - j],
+
+        i.e., the filter is centered on input sample samples0 + k*dec,
+        like the FFT filter that was used on whole frequency blocks.
+        Only the output samples that are kept are calculated, and the
+        filter state is kept between calls, so input can be pushed one
+        receive buffer (at most max_chunk samples) at a time.
+
+        With sc16=True the input is sc16 samples (interleaved int16 I and Q,
+        as a uint32 array), and the conversion to float (1/32767) is part
+        of the filter taps.
+        """
+        self.sc16=sc16
+        self.w=n.array(w[::-1], dtype=n.complex64)
+        if sc16:
+            self.w=self.w/n.float32(32767.0)
+        self.dec=dec
+        self.fl=len(w)
+        self.delay=int(self.fl/2)
+        self.samples0=samples0
+        self.max_chunk=max_chunk
+        # input samples, starting with history needed by the next output
+        self.buf=n.zeros(self.fl+max_chunk+dec, dtype=n.complex64)
+        self.out=n.zeros(int((self.fl+max_chunk)/dec)+2, dtype=n.complex64)
+        self.reset(samples0)
+
+    def reset(self, idx):
+        """ start again at input sample idx, with zeros before it """
+        # next output sample
+        self.k=int(n.ceil((idx-self.samples0)/float(self.dec)))
+        # absolute input index of buf[0]: first input of the next output
+        self.buf_start=self.samples0+self.k*self.dec+self.delay-(self.fl-1)
+        self.n_buf=idx-self.buf_start
+        self.buf[:self.n_buf]=0
+        self.next_sample=idx
+
+    def filter(self, z):
+        """ add contiguous input z (at most max_chunk samples), return new output samples """
+        if self.sc16 and z.dtype != n.complex64:
+            iq=z.view(n.int16)
+            b=self.buf[self.n_buf:(self.n_buf+len(z))]
+            b.real=iq[0::2]
+            b.imag=iq[1::2]
+        else:
+            self.buf[self.n_buf:(self.n_buf+len(z))]=z
+        self.n_buf+=len(z)
+        self.next_sample+=len(z)
+
+        # outputs whose last input sample has been received
+        n_out=max(0, int((self.n_buf-self.fl)/self.dec)+1)
+        k0=self.k
+        if n_out > 0:
+            windows=n.lib.stride_tricks.as_strided(self.buf,
+                                                   shape=(n_out, self.fl),
+                                                   strides=(self.dec*self.buf.itemsize, self.buf.itemsize))
+            n.dot(windows, self.w, out=self.out[:n_out])
+            # keep the inputs that the next output needs
+            used=n_out*self.dec
+            self.buf[:(self.n_buf-used)]=self.buf[used:self.n_buf]
+            self.n_buf-=used
+            self.buf_start+=used
+            self.k+=n_out
+        return(k0, self.out[:n_out])
+
+    def push(self, idx, z):
+        """
+        Add input samples z, starting at absolute input sample index idx.
+        Gaps shorter than max_chunk are filled with zeros. After a longer
+        gap, the filter is restarted at idx. Samples before the next expected
+        sample are ignored. Returns the index of the first output sample
+        (output k corresponds to input sample samples0+k*dec), the output
+        samples (a view of an internal buffer, valid until the next call),
+        and the gap in input samples.
+        """
+        gap=idx-self.next_sample
+        if gap < 0:
+            z=z[min(-gap, len(z)):]
+        elif gap > self.max_chunk:
+            # flush outputs that need the start of the gap, which are lost, and restart
+            self.reset(idx)
+        elif gap > 0:
+            # filter zeros for the missing samples first
+            k0, out=self.filter(n.zeros(gap, dtype=n.complex64))
+            out=out.copy()
+            k1, out1=self.filter(z)
+            return(k0, n.concatenate((out, out1)), gap)
+        k0, out=self.filter(z)
+        return(k0, out, gap)
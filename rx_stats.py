@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Ingest health counters for the receive loop.
+
+Counts received packets and samples, gaps in the sample stream, receive
+errors reported by the USRP in the receive metadata, and records how long
+each receive call waited and how long the loop took to process the
+samples (as log2 histograms in microseconds), the depth of the writer
+queue and the fill level of the receive ring.
+
+A compact snapshot is appended to a JSON lines file once per sweep, so
+that the real-time margin and data loss can be followed without reading
+the log.
+"""
+import json
+import math
+import os
+import time
+
+# log2 histogram bins in microseconds: bin i counts 2^(i-1) <= t < 2^i us
+N_BINS=24
+
+
+def log2_bin(t):
+    """ histogram bin of time t in seconds """
+    return(min(N_BINS-1, max(0, math.frexp(t*1e6)[1])))
+
+
+def error_name(error_code):
+    """ e.g., RXMetadataErrorCode.overflow -> overflow """
+    return(str(error_code).split(".")[-1])
+
+
+class counters:
+    def __init__(self):
+        self.packets=0
+        self.empty=0
+        self.samples=0
+        self.gaps=0
+        self.gap_samples=0
+        self.overlap_samples=0
+        self.max_gap=0
+        self.errors={}
+        self.out_of_sequence=0
+        self.recv_hist=[0]*N_BINS
+        self.proc_hist=[0]*N_BINS
+        # largest fraction of the duration of a receive buffer spent processing it
+        self.max_load=0.0
+        self.max_queue=0
+        self.max_ring_fill=0.0
+        self.dropped=0
+
+    def add(self, c):
+        for k, v in c.__dict__.items():
+            if k == "errors":
+                for e, ne in v.items():
+                    self.errors[e]=self.errors.get(e, 0)+ne
+            elif isinstance(v, list):
+                self.__dict__[k]=[a+b for a, b in zip(self.__dict__[k], v)]
+            elif k.startswith("max_"):
+                self.__dict__[k]=max(self.__dict__[k], v)
+            else:
+                self.__dict__[k]+=v
+
+    def to_dict(self):
+        d=dict(self.__dict__)
+        # trim empty bins at the end of the histograms
+        for k in ["recv_hist", "proc_hist"]:
+            h=list(d[k])
+            while len(h) > 0 and h[-1] == 0:
+                h.pop()
+            d[k]=h
+        return(d)
+
+
+class rx_stats:
+    def __init__(self, fname, sample_rate, log=None):
+        """
+        Append snapshots to fname (no file is written if fname is empty)
+        """
+        self.fname=fname
+        self.sample_rate=sample_rate
+        self.log=log
+        self.sweep=counters()
+        self.total=counters()
+        self.t_start=time.time()
+
+    def recv(self, num_rx_samps, md, t_recv):
+        """ a receive call returned num_rx_samps samples after t_recv seconds """
+        c=self.sweep
+        if num_rx_samps == 0:
+            c.empty+=1
+        else:
+            c.packets+=1
+            c.samples+=num_rx_samps
+        err=error_name(md.error_code)
+        if err != "none":
+            c.errors[err]=c.errors.get(err, 0)+1
+        if md.out_of_sequence:
+            c.out_of_sequence+=1
+        c.recv_hist[log2_bin(t_recv)]+=1
+
+    def gap(self, gap):
+        """ gap in samples before a receive buffer (negative if the buffers overlap) """
+        c=self.sweep
+        if gap > 0:
+            c.gaps+=1
+            c.gap_samples+=gap
+            c.max_gap=max(c.max_gap, gap)
+        elif gap < 0:
+            c.overlap_samples+=-gap
+
+    def processed(self, num_rx_samps, t_proc):
+        """ t_proc seconds were spent processing num_rx_samps samples """
+        c=self.sweep
+        c.proc_hist[log2_bin(t_proc)]+=1
+        if num_rx_samps > 0:
+            c.max_load=max(c.max_load, t_proc*self.sample_rate/num_rx_samps)
+
+    def queue(self, depth, ring_fill):
+        """ writer queue depth and receive ring fill level (0..1) """
+        c=self.sweep
+        c.max_queue=max(c.max_queue, depth)
+        c.max_ring_fill=max(c.max_ring_fill, ring_fill)
+
+    def dropped(self, n_dropped=1):
+        self.sweep.dropped+=n_dropped
+
+    def snapshot(self, sweep_t0):
+        """ write counters of the sweep that started at sweep_t0, and start a new sweep """
+        self.total.add(self.sweep)
+        d={"t0":sweep_t0,
+           "t":time.time(),
+           "uptime":time.time()-self.t_start,
+           "sweep":self.sweep.to_dict(),
+           "total":{"packets":self.total.packets,
+                    "samples":self.total.samples,
+                    "gaps":self.total.gaps,
+                    "gap_samples":self.total.gap_samples,
+                    "errors":self.total.errors,
+                    "dropped":self.total.dropped}}
+        self.sweep=counters()
+        if self.fname != "":
+            try:
+                dname=os.path.dirname(self.fname)
+                if dname != "" and not os.path.exists(dname):
+                    os.makedirs(dname)
+                with open(self.fname, "a") as f:
+                    f.write("%s\n" % (json.dumps(d, separators=(",", ":"))))
+            except OSError as e:
+                print("error writing stats to %s (%s)" % (self.fname, str(e)))
+        return(d)
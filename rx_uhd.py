@@ -30,6 +30,12 @@ from datetime import datetime, timedelta
 import traceback
 
 import create_waveform as cf
+import sweep_manifest
+import shm_ring
+import rx_ingest
+import rx_writer
+import rx_stats
+import timed_scheduler
 
 WantExit = False        # Used to signal an orderly exit
 
@@ -70,6 +76,7 @@ def delete_old_files(t0, data_path="/dev/shm"):
                 os.system("rm %s" % (f))
         except Exception as e:
             print("Error deleting file %s" % (f))
+    sweep_manifest.delete_old_manifests(t0-1, data_path)
 
 
 def lpf(dec=10, filter_len=4):
@@ -83,35 +90,25 @@ def lpf(dec=10, filter_len=4):
     return(wfun)
 
 
-def write_to_file(recv_buffer, fname, log, dec=10):
+def write_to_file(obuf, fname, log, manifest=None, fi=0, ring=None, slot=0, code_dec=1):
+    """
+    Decimate samples obuf further by code_dec, if the code of this frequency
+    has a narrower bandwidth, and write to file fname atomically, or to slot
+    of the shared memory ring buffer ring.
+    Then record the file as frequency fi in the sweep manifest.
+    """
     print("writing to file %s" % (fname))
+    obuf=cf.decimate(obuf, code_dec)
 
-    # this is a better low pass filter.
-    w=cf.lpf(dec=dec,om_factor=0.5,filter_len=8)
-    #    w=lpf(dec=dec)
-    # todo: read filter length from create_waveforms, where it is determined
-    #
-    # 
-    #w=ss.flattop(52)
-    # fix this!
-    fl=len(w)
-    # filter, time shift, decimate, and cast to complex64 data type
-    obuf=n.array(
-        n.roll(
-            n.fft.ifft(
-                n.fft.fft(w, len(recv_buffer))
-                * n.fft.fft(recv_buffer)),
-            -int(fl/2)
-            )[0:len(recv_buffer):dec],
-        dtype=n.complex64)
-
-    # rectangular impulse response. better for range resolution,
-    # but not very good for frequency selectivity.
-#    obuf=stuffr.decimate(recv_buffer,dec=dec)
-    obuf.tofile(fname)
+    if ring is None:
+        sweep_manifest.write_raw(fname, obuf)
+    else:
+        ring.write(slot, manifest.t0, fi, obuf)
+    if manifest is not None:
+        manifest.add(fi, fname, len(obuf), slot=None if ring is None else slot)
 
 
-def receive_continuous(u, t0, t_now, ic, log, sample_rate=1000000.0):
+def receive_continuous(u, t0, t_now, ic, log, sample_rate=1000000.0, usrp_lock=None):
     """
     New receive script, which processes data incoming from the usrp
     one packet at a time.
@@ -119,7 +116,10 @@ def receive_continuous(u, t0, t_now, ic, log, sample_rate=1000000.0):
     global WantExit
 
     s=ic.s
-    gps_mon=gl.gpsdo_monitor(u, log, exit_on_lost_lock=False)
+    if usrp_lock is None:
+        usrp_lock=threading.Lock()
+    # the GPS lock is polled in a background thread. check() only reads the cached state
+    gps_mon=gl.gpsdo_monitor(u, log, exit_on_lost_lock=False, lock=usrp_lock)
     # sweep timing and frequencies
     fvec=[]
     t0s=[]
@@ -138,7 +138,7 @@ def receive_continuous(u, t0, t_now, ic, log, sample_rate=1000000.0):
     t_now=u.get_time_now().get_real_secs()
 
     # setup usrp to stream continuously, starting at t0
-    stream_args=uhd.usrp.StreamArgs("fc32", "sc16")
+    stream_args=uhd.usrp.StreamArgs(ic.rx_host_format, "sc16")
     rx_stream=u.get_rx_stream(stream_args)
     stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
     stream_cmd.stream_now=False
@@ -149,26 +149,29 @@ def receive_continuous(u, t0, t_now, ic, log, sample_rate=1000000.0):
     # this is how many samples we expect to get from each packet
     max_samps_per_packet = rx_stream.get_max_num_samps()
 
-    # receive buffer size large enough to fit one packet
-    recv_buffer=n.zeros(max_samps_per_packet, dtype=n.complex64)
+    # receive several packets with each call to recv
+    packets_per_recv=8
+    if ic.rx_host_format == "sc16":
+        # interleaved int16 I and Q, one uint32 per sample
+        recv_buffer=n.zeros(packets_per_recv*max_samps_per_packet, dtype=n.uint32)
+    else:
+        recv_buffer=n.zeros(packets_per_recv*max_samps_per_packet, dtype=n.complex64)
+
+    # decimation of the raw voltage stored for the analysis
+    dec=ic.dec
 
     # initial timeout is long enough for us to receive the first packet, which
     # happens at t0
     timeout=(t0-t_now)+5.0
 
-    # store data in this ringbuffer, and offload it to ram disk once
-    # one full cycle is finished
-    output_buffer = n.zeros(2*int(s.freq_dur*sample_rate), dtype=n.complex64)
-
-    # use this buffer to write to a file
-    wr_buff = n.zeros(int(s.freq_dur*sample_rate), dtype=n.complex64)
-    bl=len(output_buffer)
-    bi=0
 
-    # frequency index
-    fi = 0
-    # samples since 1970 for the previous packet (no previous packet at first)
-    prev_samples = -1
+    # shared memory ring buffer with room for two sweeps of decimated samples
+    ring=None
+    if ic.transport == "shm":
+        ring=shm_ring.shm_ring(ic.shm_name,
+                               n_slots=2*s.n_freqs,
+                               slot_samples=int(n.ceil(s.freq_dur*sample_rate/dec)),
+                               create=True)
 
     # samples since 1970 for the first packet.
     samples0=int(stream_cmd.time_spec.get_full_secs())*int(sample_rate) + \
@@ -178,19 +181,58 @@ def receive_continuous(u, t0, t_now, ic, log, sample_rate=1000000.0):
     n_per_freq=int(s.freq_dur*sample_rate)
     n_per_sweep=int(s.sweep_len_s*sample_rate)
 
+    # low pass filter and decimate each received buffer as it arrives.
+    # this is a better low pass filter.
+    #    w=lpf(dec=dec)
+    # rectangular impulse response is better for range resolution,
+    # but not very good for frequency selectivity.
+    # todo: read filter length from create_waveforms, where it is determined
+    w=cf.lpf(dec=dec, om_factor=0.5, filter_len=8)
+    decimator=rx_ingest.fir_decimator(w, dec, samples0, max_chunk=len(recv_buffer),
+                                      sc16=ic.rx_host_format == "sc16")
+
+    # store decimated data in this ringbuffer, and offload it to ram disk once
+    # each frequency is finished. decimated sample k is raw sample samples0+k*dec
+    n_dec_per_freq=int(n_per_freq/dec)
+    ingest=rx_ingest.ring_ingest(2*n_dec_per_freq, 0)
+
+    # each frequency is copied to one of a few preallocated buffers
+    # and written by persistent writer threads
+    writer=rx_writer.rx_writer(n_dec_per_freq,
+                               n_buffers=ic.rx_write_buffers,
+                               n_workers=ic.rx_write_workers,
+                               log=log)
+
+    # ingest health counters
+    stats=rx_stats.rx_stats(ic.rx_stats_file, sample_rate, log=log)
+
     sweep_num=0
     freq_num=0
-    next_sample = samples0 + n_per_freq
+    # first decimated sample of the frequency being received
+    block_start = 0
     cycle_t0 = t0
 
-    # setup tuning for next frequency
-    tune_at(u, t0+s.freq_dur, f0=s.freq(1))
+    # list of frequencies written to the ram disk for this sweep.
+    manifest=sweep_manifest.sweep_manifest(ic.data_dir, cycle_t0, s.n_freqs, s.freq_dur, sample_rate/dec)
+
+    # tuning to the next frequency at the end of each frequency is
+    # issued ahead of time by the scheduler thread, one sweep at a time
+    sched=timed_scheduler.timed_scheduler(u, log, lock=usrp_lock)
+
+    def schedule_sweep(sweep_t0):
+        for e in timed_scheduler.sweep_timeline(s, sweep_t0):
+            if e["kind"] == "tune":
+                sched.add(e["t"], tune_at, u, e["t"], e["f0"])
+    schedule_sweep(cycle_t0)
 
     locked=True
     Exit = False
     try:
         while locked and not Exit:
+            t_recv=time.time()
             num_rx_samps=rx_stream.recv(recv_buffer, md, timeout=timeout)
+            t_proc=time.time()
+            stats.recv(num_rx_samps, md, t_proc-t_recv)
             if num_rx_samps == 0:
                 # shit happened. we probably lost a packet.
                 log.log("dropped packet. number of received samples is 0")
@@ -200,54 +242,44 @@ def receive_continuous(u, t0, t_now, ic, log, sample_rate=1000000.0):
             samples=int(md.time_spec.get_full_secs())*int(sample_rate) + \
                 int(md.time_spec.get_frac_secs()*sample_rate)
 
-            # this is how many samples we have jumped forward.
-            step = samples-prev_samples
-
-            if prev_samples == -1:
-                step = num_rx_samps
-
-            if step != 363 or num_rx_samps != 363:
-                log.log("anomalous step %d num_rx_samps %d " % (step, num_rx_samps))
-
-            prev_samples=samples
-
-            # write the result into the output buffer
-            output_buffer[n.mod(bi+n.arange(num_rx_samps, dtype=n.uint64), bl)]=recv_buffer
-
-            bi=bi+step
-
-            if samples > next_sample:
-                # this should be correct now.
-                idx0=sweep_num*n_per_sweep+freq_num*n_per_freq
-
-                wr_buff[:]=output_buffer[n.mod(idx0+n.arange(n_per_freq, dtype=n.uint64), bl)]
-
-                # spin of a thread to write all samples obtained while sounding this frequency
-                # todo: pass decimtaiton option, and pass transmit bandwidth
-                wr_thread=threading.Thread(target=write_to_file,
-                                           args=(wr_buff, "%s/raw-%d-%03d.bin"
-                                                          % (ic.data_dir, cycle_t0, freq_num), log))
-                wr_thread.start()
+            # filter and decimate, and write the result into the ring buffer.
+            # missing samples are replaced with zeros
+            k0, z_dec, gap=decimator.push(samples, recv_buffer[:num_rx_samps])
+            if gap != 0:
+                log.log("anomalous step %d num_rx_samps %d " % (gap, num_rx_samps))
+            stats.gap(gap)
+            ingest.push(k0, z_dec)
+            stats.queue(writer.depth(), (ingest.next_sample-block_start)/float(ingest.ring_len))
+
+            if ingest.ready(block_start, n_dec_per_freq):
+                # all decimated samples of this frequency, a view of the ring buffer
+                wr_buff=ingest.block(block_start, n_dec_per_freq)
+
+                # write all samples obtained while sounding this frequency in a writer thread.
+                # don't block the receive loop: drop the frequency if there is no free buffer
+                # todo: pass transmit bandwidth
+                if not writer.put(wr_buff, write_to_file,
+                                  "%s/raw-%d-%03d.bin" % (ic.data_dir, cycle_t0, freq_num), log,
+                                  manifest=manifest,
+                                  fi=freq_num,
+                                  ring=ring,
+                                  slot=(sweep_num*s.n_freqs+freq_num) % (2*s.n_freqs),
+                                  code_dec=ic.code_decs[s.code_idx(freq_num)]):
+                    stats.dropped()
                 freq_num += 1
 
-                # setup tuning for next frequency
-                tune_time = cycle_t0 + (freq_num + 1) * s.freq_dur
-                tune_time_dt = datetime.fromtimestamp(tune_time)
-                tune_at(u, tune_time, f0=s.freq(freq_num + 1))
-                print(
-                    "Tuning to %1.2f at %1.2f (%s)"
-                    % (
-                        s.freq(freq_num + 1) / 1e6,
-                        tune_time,
-                        tune_time_dt.strftime("%FT%T.%f")[:-3]
-                    )
-                )
-
                 # the cycle is over
                 if freq_num == s.n_freqs:
+                    st=stats.snapshot(cycle_t0)["sweep"]
+                    log.log("Sweep %d packets %d gaps %d (%d samples) errors %s dropped %d max load %1.2f"
+                            % (cycle_t0, st["packets"], st["gaps"], st["gap_samples"],
+                               str(st["errors"]), st["dropped"], st["max_load"]))
+                    log.log(sched.summary())
                     cycle_t0 += s.sweep_len_s
                     freq_num=0
                     sweep_num+=1
+                    schedule_sweep(cycle_t0)
+                    manifest=sweep_manifest.sweep_manifest(ic.data_dir, cycle_t0, s.n_freqs, s.freq_dur, sample_rate/dec)
 
                     locked=gps_mon.check()
                     log.log(
@@ -261,9 +293,10 @@ def receive_continuous(u, t0, t_now, ic, log, sample_rate=1000000.0):
 
 
                 # we've got a full freq step
-                next_sample += n_per_freq
+                block_start = int(n.ceil((sweep_num*n_per_sweep + freq_num*n_per_freq)/float(dec)))
 
             timeout=0.1
+            stats.processed(num_rx_samps, time.time()-t_proc)
     except Exception as e:
         traceback.print_exc()
         traceback.print_stack()
@@ -279,17 +312,23 @@ def receive_continuous(u, t0, t_now, ic, log, sample_rate=1000000.0):
         print(".", end='')
         num_rx_samps=rx_stream.recv(recv_buffer, md, timeout=0.1)
     print("\nStream stopped")
+    writer.close()
+    sched.stop()
+    gps_mon.stop()
+    if writer.n_dropped > 0:
+        log.log("%d frequencies were dropped" % (writer.n_dropped))
     exit(0)
     return
 
 
-def housekeeping(usrp, log, ic):
+def housekeeping(usrp, log, ic, usrp_lock):
     """
     Delete raw voltage files in ringbuffer
     """
     try:
         while True:
-            t0=usrp.get_time_now().get_real_secs()
+            with usrp_lock:
+                t0=usrp.get_time_now().get_real_secs()
             delete_old_files(int(t0)-int(ic.s.sweep_len_s)*3, ic.data_dir)
             t0+=np.uint64(ic.s.sweep_len_s)
 
@@ -354,13 +393,16 @@ def main(ic):
     tune_req=uhd.libpyuhd.types.tune_request(s.freq(0))
     usrp.set_rx_freq(tune_req)
 
+    # held by threads that talk to the usrp while timed commands are issued
+    usrp_lock=threading.Lock()
+
     # start reading data
-    housekeeping_thread=threading.Thread(target=housekeeping, args=(usrp, log, ic))
+    housekeeping_thread=threading.Thread(target=housekeeping, args=(usrp, log, ic, usrp_lock))
     housekeeping_thread.daemon=True
     housekeeping_thread.start()
 
     # infinitely loop on receive
-    receive_continuous(usrp, t0, t_now, ic, log)
+    receive_continuous(usrp, t0, t_now, ic, log, sample_rate=sample_rate, usrp_lock=usrp_lock)
 
 
 if __name__ == "__main__":
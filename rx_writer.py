@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Writers for the decimated raw voltage of each frequency in the receiver.
+
+The samples of a frequency are copied into one of a fixed pool of
+preallocated buffers, and one or two persistent writer threads write
+them to a file or to the shared memory ring buffer. The buffer is
+returned to the pool when the write is done, so the receive ring can be
+overwritten while the writers are busy, and the number of pending writes
+and the memory used for them is bounded.
+
+If all buffers are in use, submitting waits at most a few milliseconds,
+which is much less than the USRP can buffer. If no buffer is freed in
+that time, the frequency is dropped and counted, instead of stalling the
+receive loop and causing overflows in the following frequencies.
+"""
+import queue
+import threading
+
+import numpy as n
+
+
+class rx_writer:
+    def __init__(self, n_samples, n_buffers=4, n_workers=1, log=None):
+        """
+        n_buffers buffers of at most n_samples samples, written by n_workers threads
+        """
+        self.buffers=n.zeros((n_buffers, n_samples), dtype=n.complex64)
+        self.free=queue.Queue()
+        for i in range(n_buffers):
+            self.free.put(i)
+        self.jobs=queue.Queue()
+        self.log=log
+        # frequencies that were dropped, because no buffer was available,
+        # and frequencies that failed to be written
+        self.n_dropped=0
+        self.n_failed=0
+        self.workers=[]
+        for i in range(n_workers):
+            w=threading.Thread(target=self.worker, daemon=True)
+            w.start()
+            self.workers.append(w)
+
+    def worker(self):
+        while True:
+            job=self.jobs.get()
+            if job is None:
+                break
+            bi, n_samples, fun, args, kwargs=job
+            try:
+                fun(self.buffers[bi, :n_samples], *args, **kwargs)
+            except Exception as e:
+                self.n_failed+=1
+                self.message("%s %s failed (%s)" % (fun.__name__, str(args[0]) if args else "", str(e)))
+            finally:
+                self.free.put(bi)
+
+    def message(self, msg):
+        if self.log is None:
+            print(msg)
+        else:
+            self.log.log(msg)
+
+    def put(self, z, fun, *args, timeout=0.005, **kwargs):
+        """
+        Copy samples z to a free buffer, and call fun(buffer, *args, **kwargs)
+        in a writer thread. Waits at most timeout seconds for a free buffer.
+        Returns False if the samples were dropped.
+        """
+        try:
+            bi=self.free.get(timeout=timeout)
+        except queue.Empty:
+            self.n_dropped+=1
+            self.message("no free write buffer. dropped %s (%d dropped)" % (str(args[0]) if args else "", self.n_dropped))
+            return(False)
+        self.buffers[bi, :len(z)]=z
+        self.jobs.put((bi, len(z), fun, args, kwargs))
+        return(True)
+
+    def depth(self):
+        """ number of writes waiting or in progress """
+        return(self.buffers.shape[0]-self.free.qsize())
+
+    def close(self):
+        """ wait until all writes are done and stop the writer threads """
+        for w in self.workers:
+            self.jobs.put(None)
+        for w in self.workers:
+            w.join()
+        self.workers=[]
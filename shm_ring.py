@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Shared memory ring buffer of decimated raw voltage, written by the
+receiver and read by the analysis, as an alternative to raw voltage files
+on the ram disk (transport="shm" in the configuration).
+
+The ring has one slot per frequency for two sweeps. Each slot has a small
+header (sequence number, status, sweep start time, frequency index and
+number of samples). The writer marks a slot as being written, copies the
+samples, and then marks it ready. Readers find slots by sweep start time
+and frequency index, and copy the samples out of the slot. The sequence
+number and the header are checked after copying, so samples of a slot
+that was overwritten during the copy are never used. A slot is
+overwritten two sweeps after it was written, so a sweep must be read
+before that.
+"""
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as n
+
+MAGIC=0x696f6e6f72696e67
+
+EMPTY=0
+WRITING=1
+READY=2
+
+ring_header_dtype=n.dtype([("magic", n.uint64),
+                           ("n_slots", n.int64),
+                           ("slot_samples", n.int64)])
+
+slot_header_dtype=n.dtype([("seq", n.uint64),
+                           ("status", n.int64),
+                           ("t0", n.int64),
+                           ("fi", n.int64),
+                           ("n_samples", n.int64)])
+
+
+def data_offset(n_slots):
+    """ samples start at a page boundary after the headers """
+    hdr_bytes=ring_header_dtype.itemsize+n_slots*slot_header_dtype.itemsize
+    return(int(n.ceil(hdr_bytes/4096.0))*4096)
+
+
+def ring_bytes(n_slots, slot_samples):
+    return(data_offset(n_slots)+n_slots*slot_samples*n.dtype(n.complex64).itemsize)
+
+
+def attach_shm(name):
+    """
+    Attach to existing shared memory without registering it with the
+    resource tracker, which would otherwise remove it when this process exits
+    """
+    try:
+        return(shared_memory.SharedMemory(name=name, track=False))
+    except TypeError:
+        # python < 3.13
+        shm=shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return(shm)
+
+
+class shm_ring:
+    def __init__(self, name, n_slots=0, slot_samples=0, create=False):
+        """
+        Attach to ring name. With create=True the ring is created with
+        n_slots slots of slot_samples samples. An existing ring with the
+        same size is reused, so that readers stay attached when the
+        receiver is restarted.
+        """
+        self.name=name
+        if create:
+            try:
+                shm=attach_shm(name)
+                if shm.size < ring_bytes(n_slots, slot_samples) or \
+                        n.ndarray((1,), dtype=ring_header_dtype, buffer=shm.buf)[0]["n_slots"] != n_slots:
+                    print("removing shared memory %s with different size" % (name))
+                    shm.close()
+                    shm.unlink()
+                    raise FileNotFoundError
+            except FileNotFoundError:
+                shm=shared_memory.SharedMemory(name=name, create=True, size=ring_bytes(n_slots, slot_samples))
+                resource_tracker.unregister(shm._name, "shared_memory")
+        else:
+            shm=attach_shm(name)
+        self.shm=shm
+
+        hdr=n.ndarray((1,), dtype=ring_header_dtype, buffer=shm.buf)
+        if create:
+            hdr[0]["n_slots"]=n_slots
+            hdr[0]["slot_samples"]=slot_samples
+            hdr[0]["magic"]=MAGIC
+        if hdr[0]["magic"] != MAGIC:
+            raise ValueError("shared memory %s is not a ring buffer" % (name))
+        self.n_slots=int(hdr[0]["n_slots"])
+        self.slot_samples=int(hdr[0]["slot_samples"])
+        self.slots=n.ndarray((self.n_slots,), dtype=slot_header_dtype, buffer=shm.buf,
+                             offset=ring_header_dtype.itemsize)
+        self.data=n.ndarray((self.n_slots, self.slot_samples), dtype=n.complex64, buffer=shm.buf,
+                            offset=data_offset(self.n_slots))
+
+    def write(self, slot, t0, fi, z):
+        """ copy samples z of frequency fi of sweep t0 into slot """
+        if len(z) > self.slot_samples:
+            raise ValueError("%d samples don't fit in a slot of %d samples" % (len(z), self.slot_samples))
+        s=self.slots[slot:(slot+1)]
+        s["status"]=WRITING
+        s["seq"]+=1
+        s["t0"]=t0
+        s["fi"]=fi
+        self.data[slot, :len(z)]=z
+        s["n_samples"]=len(z)
+        s["status"]=READY
+        return(int(s[0]["seq"]))
+
+    def find(self, t0, fi):
+        """ slot with frequency fi of sweep t0, or None """
+        idx=n.where((self.slots["status"] == READY) & (self.slots["t0"] == t0) & (self.slots["fi"] == fi))[0]
+        if len(idx) == 0:
+            return(None)
+        return(int(idx[0]))
+
+    def valid(self, slot, seq, t0, fi):
+        """ True if slot still has frequency fi of sweep t0, written as seq """
+        s=self.slots[slot]
+        return(s["status"] == READY and s["seq"] == seq and s["t0"] == t0 and s["fi"] == fi)
+
+    def read(self, t0, fi):
+        """
+        Copy of frequency fi of sweep t0, or None if it is not in the ring,
+        or if the slot was overwritten while it was being copied.
+        """
+        slot=self.find(t0, fi)
+        if slot is None:
+            return(None)
+        seq=int(self.slots[slot]["seq"])
+        n_samples=int(self.slots[slot]["n_samples"])
+        if not self.valid(slot, seq, t0, fi):
+            return(None)
+        z=n.array(self.data[slot, :n_samples])
+        # the writer bumps seq before it overwrites the samples
+        if not self.valid(slot, seq, t0, fi):
+            print("sweep %d frequency %d was overwritten while reading" % (t0, fi))
+            return(None)
+        return(z)
+
+    def close(self):
+        self.slots=None
+        self.data=None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+# rings that this process is attached to
+rings={}
+
+
+def get_ring(name):
+    """ attach to ring name, or return None if it doesn't exist (yet) """
+    if name not in rings:
+        try:
+            rings[name]=shm_ring(name)
+        except FileNotFoundError:
+            return(None)
+    return(rings[name])
+
+
+def reattach(name):
+    """ attach again, in case the receiver has created a new ring """
+    if name in rings:
+        r=rings.pop(name)
+        try:
+            r.close()
+        except BufferError:
+            # the old ring is still in use
+            pass
+    return(get_ring(name))
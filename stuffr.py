@@ -18,9 +18,12 @@ import h5py
 #from datetime import timezone
 # fit_velocity
 import scipy.constants
+import scipy.linalg
 import scipy.optimize
 import pytz
 
+import estimation_cache
+
 
 # xpath-like access to nested dictionaries
 # @d ditct
@@ -52,9 +55,9 @@ def periodic_convolution_matrix(envelope, rmin=0, rmax=100):
     # we imply that the number of measurements is equal to the number of elements in code
     L = len(envelope)
     ridx = numpy.arange(rmin, rmax)
-    A = numpy.zeros([L, rmax-rmin], dtype=numpy.complex64)
-    for i in numpy.arange(L):
-        A[i, :] = envelope[(i-ridx) % L]
+    # A[i, r] = envelope[(i-r) % L]
+    A = numpy.array(envelope[numpy.mod(numpy.arange(L)[:, None]-ridx[None, :], L)],
+                    dtype=numpy.complex64)
     result = {}
     result['A'] = A
     result['ridx'] = ridx
@@ -67,7 +70,8 @@ def analyze_prc_file(fname="data-000001.gdf", clen=10000, station=0, Nranges=100
     N = len(z)/clen
     res = numpy.zeros([N, Nranges], dtype=numpy.complex64)
     idx = numpy.arange(clen)
-    r = create_estimation_matrix(code=code, cache=True)
+    # copy, so that results aren't stored in the cached estimator
+    r = dict(create_estimation_matrix(code=code, rmax=Nranges, cache=True))
     B = r['B']
     spec = numpy.zeros([N, Nranges], dtype=numpy.float32)
 
@@ -80,25 +84,27 @@ def analyze_prc_file(fname="data-000001.gdf", clen=10000, station=0, Nranges=100
     return(r)
 
 
-B_cache = 0
-r_cache = 0
-B_cached = False
-
-
 def create_estimation_matrix(code, rmin=0, rmax=1000, cache=True):
-    global B_cache
-    global r_cache
-    global B_cached
-
-    if cache == False or B_cached == False:
-        r_cache = periodic_convolution_matrix(envelope=code, rmin=rmin, rmax=rmax)
-        A = r_cache['A']
-        Ah = numpy.transpose(numpy.conjugate(A))
-        B_cache = numpy.dot(numpy.linalg.inv(numpy.dot(Ah, A)), Ah)
-        r_cache['B'] = B_cache
-        B_cached = True
-
-    return(r_cache)
+    """
+    B=(A^H A)^{-1}A^H, kept in the process-wide estimation_cache.
+    A^H A is the Hermitian Toeplitz matrix given by the autocorrelation
+    function of the periodic code, so it is obtained with FFTs instead of
+    a matrix product. It is positive definite, so B is solved with a
+    Cholesky factorization instead of inverting A^H A.
+    """
+    def create():
+        r = periodic_convolution_matrix(envelope=code, rmin=rmin, rmax=rmax)
+        Ah = numpy.transpose(numpy.conjugate(r['A']))
+        C = numpy.fft.fft(code)
+        acf = numpy.fft.ifft(numpy.abs(C)**2.0)[0:(rmax-rmin)]
+        AhA = scipy.linalg.toeplitz(acf)
+        r['B'] = numpy.array(scipy.linalg.cho_solve(scipy.linalg.cho_factor(AhA, lower=True), Ah),
+                             dtype=numpy.complex64)
+        return(r)
+
+    if not cache:
+        return(create())
+    return(estimation_cache.get(estimation_cache.code_key(code, rmax, rmin=rmin, kind="stuffr"), create))
 
 
 def grid_search1d(fun, xmin, xmax, nstep=100):
@@ -10,18 +10,22 @@ class sweep():
                         "waveforms/code-l10000-b10-000000f_50k.bin",   # code 1
                         "waveforms/code-l10000-b10-000000f_30k.bin"],  # code 2
                  sample_rate=1000000,  # In Hz
-                 code_amp=0.5):
+                 code_amp=0.5,
+                 waveforms=None):  # waveform arrays of the codes. read from the code files if not given
 
         self.freq_dur=freq_dur
         self.n_freqs=len(freqs)
         self.freqs=freqs
         self.codes=codes
-        self.transmit_waveforms=[]
+        # one code period of each transmit waveform
+        self.periods=[]
         self.code_len = 0
         self.sample_rate=sample_rate
+        if waveforms is None:
+            waveforms=[n.fromfile(c, dtype=n.complex64) for c in codes]
+
         # check code lengths
-        for c in codes:
-            wf=n.fromfile(c, dtype=n.complex64)
+        for wf in waveforms:
             if self.code_len == 0:
                 self.code_len=len(wf)
             else:
@@ -29,12 +33,11 @@ class sweep():
                     print("Error. Not all waveforms are the same length!")
                     exit(0)
 
-        n_reps=int(self.freq_dur*self.sample_rate/self.code_len)
+        # how many code periods are transmitted on each frequency
+        self.n_reps=int(self.freq_dur*self.sample_rate/self.code_len)
 
-        # todo: use waveforms created in iono_config
-        for c in codes:
-            wf=code_amp*n.fromfile(c, dtype=n.complex64)
-            self.transmit_waveforms.append(n.tile(wf, n_reps))
+        for wf in waveforms:
+            self.periods.append(n.array(code_amp*wf, dtype=n.complex64))
 
         self.determine_sweep_length()
         self.t0=n.arange(self.n_freqs, dtype=n.float64)*self.freq_dur
@@ -59,9 +62,16 @@ class sweep():
         return(self.freqs[i % self.n_freqs][0]*1e6)
 
     def waveform(self, i):
-        """ get waveform array for cycle i """
+        """
+        get waveform array for cycle i. this creates the whole waveform,
+        the transmitter sends one period at a time
+        """
+        return(n.tile(self.period(i), self.n_reps))
+
+    def period(self, i):
+        """ one code period of the waveform for cycle i """
         code_idx=self.freqs[i % self.n_freqs][1]
-        return(self.transmit_waveforms[code_idx])
+        return(self.periods[code_idx])
 
     def pars(self, i):
         """ freq, time for cycle i """
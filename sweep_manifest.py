@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Handoff of raw voltage files from the receiver to the analysis.
+
+The receiver writes each raw voltage file under a temporary name and
+renames it when it is complete, so a raw-<t0>-<i>.bin file is never seen
+partially written. For each sweep, the receiver also maintains a small
+manifest sweep-<t0>.json, which lists the frequencies that have been
+written so far, and is marked complete when all frequencies of the sweep
+have been written. The manifest is also replaced atomically.
+"""
+import glob
+import json
+import os
+import re
+import threading
+import time
+
+
+def manifest_fname(data_path, t0):
+    return("%s/sweep-%d.json" % (data_path, t0))
+
+
+def tmp_fname(fname):
+    """ temporary name that doesn't match raw*.bin or sweep-*.json """
+    dname, bname=os.path.split(fname)
+    return(os.path.join(dname, ".tmp-%s" % (bname)))
+
+
+def write_raw(fname, a):
+    """ write array to file atomically """
+    tmp=tmp_fname(fname)
+    try:
+        a.tofile(tmp)
+        os.replace(tmp, fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_json(fname, d):
+    """ write json file atomically """
+    tmp=tmp_fname(fname)
+    with open(tmp, "w") as f:
+        json.dump(d, f)
+    os.replace(tmp, fname)
+
+
+def read_manifest(data_path, t0):
+    """ manifest of sweep t0, or None if there isn't one (yet) """
+    try:
+        with open(manifest_fname(data_path, t0), "r") as f:
+            return(json.load(f))
+    except (OSError, ValueError):
+        return(None)
+
+
+def sweeps(data_path):
+    """ start times of the sweeps that have a manifest in data_path """
+    t0s=[]
+    for f in glob.glob("%s/sweep-*.json" % (data_path)):
+        m=re.search(".*/sweep-([0-9]+).json", f)
+        if m is not None:
+            t0s.append(int(m.group(1)))
+    return(sorted(t0s))
+
+
+def delete_old_manifests(t0, data_path="/dev/shm"):
+    """ delete manifests of sweeps that started at t0 or earlier """
+    for t1 in sweeps(data_path):
+        if t1 <= t0:
+            try:
+                os.remove(manifest_fname(data_path, t1))
+            except OSError:
+                print("error deleting manifest of sweep %d" % (t1))
+
+
+class sweep_manifest:
+    def __init__(self, data_path, t0, n_freqs, freq_dur, sample_rate):
+        """
+        Manifest of the sweep starting at t0. sample_rate is the sample
+        rate of the raw voltage files.
+        """
+        self.data_path=data_path
+        self.t0=int(t0)
+        self.n_freqs=n_freqs
+        self.freq_dur=freq_dur
+        self.sample_rate=sample_rate
+        self.files={}
+        self.lock=threading.Lock()
+        with self.lock:
+            self.write()
+
+    def add(self, fi, fname, n_samples, slot=None):
+        """
+        Record frequency fi, which has been written to fname,
+        or to slot of the shared memory ring buffer.
+        Can be called from several writer threads.
+        """
+        with self.lock:
+            self.files[fi]={"fname":os.path.basename(fname),
+                            "n_samples":int(n_samples),
+                            "t_written":time.time()}
+            if slot is not None:
+                self.files[fi]["slot"]=int(slot)
+            self.write()
+
+    def write(self):
+        d={"t0":self.t0,
+           "n_freqs":self.n_freqs,
+           "freq_dur":self.freq_dur,
+           "sample_rate":self.sample_rate,
+           "files":{"%d" % (fi):f for fi, f in self.files.items()},
+           "complete":len(self.files) == self.n_freqs}
+        write_json(manifest_fname(self.data_path, self.t0), d)
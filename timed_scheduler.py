@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Timed command scheduler for the transmitter and the receiver.
+
+The events of a whole sweep (tuning, GPIO/antenna select, transmit
+bursts) are calculated in advance from sweep.pars(), and a dedicated
+thread issues each one lead_time seconds before it is due. The commands
+are timed commands, so they take effect at the exact sample time even
+if they are issued early, and a slow main loop doesn't delay them.
+
+The slack of each command (how long before its time it was issued, in
+USRP time) is recorded, so that late commands can be detected.
+
+USRP calls that set the command time are made while holding a lock,
+which other threads that talk to the USRP (e.g., the GPS monitor)
+should also use, so that their commands don't become timed commands.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+
+def sweep_timeline(s, sweep_t0, tune_offset=0.0):
+    """
+    Events of the sweep starting at sweep_t0, ordered by time.
+    Each frequency i has a "burst" event at its start, and a "tune" event
+    to the next frequency at the end of frequency i plus tune_offset.
+    Events are dicts with t (USRP time), kind, fi (frequency index)
+    and f0 (center frequency in Hz).
+    """
+    events=[]
+    for i in range(s.n_freqs):
+        f0, dt=s.pars(i)
+        events.append({"t":sweep_t0+dt, "kind":"burst", "fi":i, "f0":f0})
+        events.append({"t":sweep_t0+dt+s.freq_dur+tune_offset, "kind":"tune", "fi":i+1, "f0":s.freq(i+1)})
+    events.sort(key=lambda e: e["t"])
+    return(events)
+
+
+class timed_scheduler:
+    def __init__(self, u, log, lead_time=1.0, late_slack=0.01, lock=None):
+        """
+        Issue events lead_time seconds before they are due. Commands issued
+        less than late_slack seconds before their time are logged as late.
+        """
+        self.u=u
+        self.log=log
+        self.lead_time=lead_time
+        self.late_slack=late_slack
+        if lock is None:
+            lock=threading.Lock()
+        self.lock=lock
+
+        self.events=[]
+        self.counter=itertools.count()
+        self.cond=threading.Condition()
+        self.stopped=False
+
+        # usrp time minus host time, updated when events are issued
+        with self.lock:
+            self.clock_offset=self.u.get_time_now().get_real_secs()-time.time()
+
+        self.reset_stats()
+        self.thread=threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def reset_stats(self):
+        self.n_issued=0
+        self.n_late=0
+        self.min_slack=None
+
+    def usrp_time(self):
+        """ estimate of the current usrp time, without talking to the usrp """
+        return(time.time()+self.clock_offset)
+
+    def add(self, t, fun, *args, locked=True):
+        """
+        Call fun(*args) lead_time seconds before usrp time t. With locked=True
+        (timed commands) the usrp lock is held during the call. Calls that may
+        block (e.g., queueing a transmit burst) should use locked=False.
+        """
+        with self.cond:
+            heapq.heappush(self.events, (t, next(self.counter), fun, args, locked))
+            self.cond.notify()
+
+    def pending(self):
+        with self.cond:
+            return(len(self.events))
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.stopped:
+                    if len(self.events) > 0:
+                        wait=self.events[0][0]-self.lead_time-self.usrp_time()
+                        if wait <= 0.0:
+                            break
+                    else:
+                        wait=None
+                    self.cond.wait(wait)
+                if self.stopped:
+                    return
+                t, k, fun, args, locked=heapq.heappop(self.events)
+            self.issue(t, fun, args, locked)
+
+    def issue(self, t, fun, args, locked=True):
+        with self.lock:
+            t_now=self.u.get_time_now().get_real_secs()
+            self.clock_offset=t_now-time.time()
+            slack=t-t_now
+            if locked:
+                self.call(t, fun, args)
+        if not locked:
+            self.call(t, fun, args)
+        self.n_issued+=1
+        if self.min_slack is None or slack < self.min_slack:
+            self.min_slack=slack
+        if slack < self.late_slack:
+            self.n_late+=1
+            self.log.log("Timed command %s at %1.3f issued with %1.3f s slack" % (fun.__name__, t, slack))
+
+    def call(self, t, fun, args):
+        try:
+            fun(*args)
+        except Exception as e:
+            self.log.log("Timed command %s at %1.2f failed (%s)" % (fun.__name__, t, str(e)))
+
+    def wait_until(self, t):
+        """ sleep until usrp time t """
+        dt=t-self.usrp_time()
+        if dt > 0:
+            time.sleep(dt)
+
+    def summary(self):
+        """ slack statistics since the last summary """
+        msg="timed commands %d late %d min slack %s" % (
+            self.n_issued, self.n_late,
+            "-" if self.min_slack is None else "%1.3f s" % (self.min_slack))
+        self.reset_stats()
+        return(msg)
+
+    def stop(self):
+        with self.cond:
+            self.stopped=True
+            self.cond.notify()
+        self.thread.join()
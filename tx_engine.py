@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Transmit engine of the ionosonde transmitter.
+
+One transmit streamer is created when the transmitter starts, and is
+used for all frequencies. Each code period is converted to the host
+sample format once (sc16 by default), and a transmit burst sends the
+same period repeatedly, with a time spec on the first packet and end of
+burst on the last one. The transmitter memory doesn't depend on the
+frequency duration, and nothing needs to be set up for each frequency.
+
+The reflected power (SWR) measurement uses one receive streamer in a
+persistent thread.
+"""
+import queue
+import threading
+import time
+from datetime import datetime
+
+import numpy as n
+import uhd
+
+
+def to_sc16(z):
+    """ complex samples (|z| <= 1) as sc16 samples: interleaved int16 I and Q in a uint32 array """
+    iq=n.zeros(2*len(z), dtype=n.int16)
+    iq[0::2]=n.clip(n.round(z.real*32767.0), -32767, 32767)
+    iq[1::2]=n.clip(n.round(z.imag*32767.0), -32767, 32767)
+    return(iq.view(n.uint32))
+
+
+class tx_engine:
+    def __init__(self, u, ic, log, host_format="sc16", lead_time=0.5, lock=None):
+        """
+        Start the transmit and reflected power threads.
+        Bursts are queued to the streamer lead_time seconds before they start.
+        lock is held while reading the usrp time (see timed_scheduler).
+        """
+        self.u=u
+        if lock is None:
+            lock=threading.Lock()
+        self.lock=lock
+        self.ic=ic
+        self.log=log
+        self.sample_rate=ic.sample_rate
+        self.host_format=host_format
+        self.lead_time=lead_time
+
+        # one period of each code, in the host sample format
+        self.periods={}
+        # set if sending a burst failed
+        self.failed=False
+
+        self.tx_stream=u.get_tx_stream(uhd.usrp.StreamArgs(host_format, "sc16"))
+        self.rx_stream=u.get_rx_stream(uhd.usrp.StreamArgs("fc32", "sc16"))
+
+        # hold SWR measurement about half of the transmit waveform length, so
+        # we have no timing issues
+        self.swr_buffer=n.zeros(int(0.5*ic.sample_rate*ic.s.freq_dur), dtype=n.complex64)
+
+        # at most one burst waits while the previous one is being sent
+        self.bursts=queue.Queue(maxsize=1)
+        self.swr_requests=queue.Queue()
+        self.tx_thread=threading.Thread(target=self.tx_loop, daemon=True)
+        self.tx_thread.start()
+        self.swr_thread=threading.Thread(target=self.swr_loop, daemon=True)
+        self.swr_thread.start()
+
+    def period(self, code_idx):
+        """ cached code period in the host sample format """
+        if code_idx not in self.periods:
+            wf=self.ic.s.periods[code_idx]
+            if self.host_format == "sc16":
+                self.periods[code_idx]=to_sc16(wf)
+            else:
+                self.periods[code_idx]=n.array(wf, dtype=n.complex64)
+        return(self.periods[code_idx])
+
+    def transmit(self, t0, code_idx, f0):
+        """
+        Queue a burst of the code code_idx at time t0 (n_reps periods),
+        and a reflected power measurement at frequency f0. Blocks while
+        the previous burst is still waiting to be sent.
+        """
+        self.bursts.put((t0, code_idx, self.ic.s.n_reps))
+        self.swr_requests.put((t0, f0))
+
+    def check(self):
+        """ exit if sending a burst has failed (call from the main thread) """
+        if self.failed:
+            self.log.log("Transmit failed. Exiting")
+            exit(0)
+
+    def send_burst(self, t0, code_idx, n_reps):
+        wf=self.period(code_idx)
+        period_len=len(wf)/float(self.sample_rate)
+
+        t0_dt=datetime.fromtimestamp(t0)
+        print("transmit start at %1.2f (%s)" % (t0, t0_dt.strftime("%FT%T.%f")[:-3]))
+
+        # wait for moment right before transmit
+        with self.lock:
+            t_now=self.u.get_time_now().get_real_secs()
+        if t_now > t0:
+            self.log.log("Delayed start for transmit %1.2f (%s)  %1.2f (%s)"
+                         % (t_now, datetime.fromtimestamp(t_now).strftime("%FT%T.%f")[:-3],
+                            t0, t0_dt.strftime("%FT%T.%f")[:-3]))
+        if t0-t_now > self.lead_time:
+            time.sleep(t0-t_now-self.lead_time)
+
+        md=uhd.types.TXMetadata()
+        md.start_of_burst=True
+        md.end_of_burst=False
+        md.has_time_spec=True
+        md.time_spec=uhd.types.TimeSpec(float(t0))
+        timeout=self.lead_time+period_len+1.0
+        for ri in range(n_reps):
+            if ri == n_reps-1:
+                md.end_of_burst=True
+            self.tx_stream.send(wf, md, timeout=timeout)
+            md.start_of_burst=False
+            md.has_time_spec=False
+            timeout=period_len+1.0
+
+    def tx_loop(self):
+        while True:
+            burst=self.bursts.get()
+            if burst is None:
+                break
+            try:
+                self.send_burst(*burst)
+            except Exception as e:
+                self.log.log("Transmit failed (%s)" % (str(e)))
+                self.failed=True
+
+    def measure_swr(self, t0, f0):
+        """
+        Receive samples for a reflected power measurement
+        USRP output connected to input with 35 dB attenuation gives
+        9.96 dB reflected power.
+        """
+        N=len(self.swr_buffer)
+        stream_cmd=uhd.types.StreamCMD(uhd.types.StreamMode.num_done)
+        stream_cmd.num_samps=N
+        stream_cmd.stream_now=False
+        stream_cmd.time_spec=uhd.types.TimeSpec(float(t0))
+        self.rx_stream.issue_stream_cmd(stream_cmd)
+        md=uhd.types.RXMetadata()
+        with self.lock:
+            t_now=self.u.get_time_now().get_real_secs()
+        num_rx_samps=self.rx_stream.recv(self.swr_buffer, md,
+                                         timeout=max(0.0, t0-t_now)+float(N/self.sample_rate)+1.0)
+        pwr=n.mean(n.abs(self.swr_buffer[:num_rx_samps])**2.0) if num_rx_samps > 0 else 0.0
+        if pwr <= 0.0:
+            pwr=1e-99
+        refl_pwr_dBm=10.0*n.log10(pwr)+self.ic.reflected_power_cal_dB
+        self.log.log("reflected pwr %1.4f (MHz) %1.4f (dBm)" % (f0/1e6, refl_pwr_dBm))
+
+    def swr_loop(self):
+        while True:
+            req=self.swr_requests.get()
+            if req is None:
+                break
+            try:
+                self.measure_swr(*req)
+            except Exception as e:
+                self.log.log("Reflected power measurement failed (%s)" % (str(e)))
+
+    def close(self):
+        """ wait until the queued bursts have been sent """
+        self.bursts.put(None)
+        self.swr_requests.put(None)
+        self.tx_thread.join()
+        self.swr_thread.join()
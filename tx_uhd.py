@@ -20,6 +20,8 @@ import sweep
 import gps_lock as gl
 import iono_logger
 import iono_config
+import timed_scheduler
+import tx_engine
 from datetime import datetime, timedelta
 
 
@@ -63,84 +65,6 @@ def tune_at(u, t0, ic, f0=4e6, gpio_state=0):
     u.clear_command_time()
 
 
-def tx_send(tx_stream, waveform, md, ic, timeout=11.0):
-    # this command will block until everything is in the transmit
-    # buffer.
-    tx_stream.send(waveform, md, timeout=(len(waveform)/float(ic.sample_rate))+1.0)
-
-
-def rx_swr(u, t0, recv_buffer, f0, log, ic):
-    """
-    Receive samples for a reflected power measurement
-    USRP output connected to input with 35 dB attenuation gives
-    9.96 dB reflected power.
-    """
-    N=len(recv_buffer)
-    stream_args=uhd.usrp.StreamArgs("fc32", "sc16")
-    rx_stream=u.get_rx_stream(stream_args)
-    stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.num_done)
-    stream_cmd.num_samps=N
-    stream_cmd.stream_now=False
-    stream_cmd.time_spec=uhd.types.TimeSpec(t0)
-    rx_stream.issue_stream_cmd(stream_cmd)
-    md=uhd.types.RXMetadata()
-    num_rx_samps=rx_stream.recv(recv_buffer, md, timeout=float(N/ic.sample_rate)+1.0)
-    pwr=n.mean(n.abs(recv_buffer)**2.0)
-    rx_stream=None
-    if pwr <= 0.0:
-        pwr=1e-99
-    refl_pwr_dBm=10.0*n.log10(pwr)+ic.reflected_power_cal_dB
-    log.log("reflected pwr %1.4f (MHz) %1.4f (dBm)" % (f0/1e6, refl_pwr_dBm))
-
-
-def transmit_waveform(u, t0_full, waveform, swr_buffer, f0, log, ic):
-    """
-    Transmit a timed burst
-    """
-    t0_ts=uhd.libpyuhd.types.time_spec(n.uint64(t0_full), 0.0)
-    stream_args=uhd.usrp.StreamArgs("fc32", "sc16")
-    md=uhd.types.TXMetadata()
-    md.has_time_spec=True
-    md.time_spec=t0_ts
-
-    t0_full_dt = datetime.fromtimestamp(t0_full)
-    print("transmit start at %1.2f (%s)" % (t0_full, t0_full_dt.strftime("%FT%T.%f")[:-3]))
-
-    # wait for moment right before transmit
-    t_now=u.get_time_now().get_real_secs()
-    t_now_dt = datetime.fromtimestamp(t_now)
-    print("setup time %1.2f (%s)" % (t_now, t_now_dt.strftime("%FT%T.%f")[:-3]))
-    if t_now > t0_full:
-        log.log(
-            "Delayed start for transmit %1.2f (%s)  %1.2f (%s)"
-            % (
-                t_now,
-                t_now_dt.strftime("%FT%T.%f")[:-3],
-                t0_full,
-                t0_full_dt.strftime("%FT%T.%f")[:-3]
-            )
-        )
-    if t0_full-t_now > 0.1:
-        time.sleep(t0_full-t_now-0.1)
-
-    try:
-        # transmit the code
-        tx_stream=u.get_tx_stream(stream_args)
-        tx_thread = threading.Thread(target=tx_send, args=(tx_stream, waveform, md, ic))
-        tx_thread.daemon=True  # exit if parent thread exits
-        tx_thread.start()
-
-        # do an swr measurement
-        rx_thread = threading.Thread(target=rx_swr, args=(u, t0_full, swr_buffer, f0, log, ic))
-        rx_thread.daemon=True  # exit if parent thread exits
-        rx_thread.start()
-        tx_thread.join()
-        rx_thread.join()
-        tx_stream=None
-    except Exception as e:
-        exit(0)
-
-
 def main(config):
     """
     The main loop for the ionosonde transmitter
@@ -170,6 +94,9 @@ def main(config):
     usrp.set_rx_subdev_spec(rx_subdev_spec)
 
     
+    # held by threads that talk to the usrp while timed commands are issued
+    usrp_lock=threading.Lock()
+
     # wait until GPS is locked, then align USRP time with global ref
     gps_mon=None
     if ic.require_gps == False:
@@ -181,16 +108,18 @@ def main(config):
         usrp.set_time_next_pps(uhd.libpyuhd.types.time_spec(int(n.ceil(time.time()))));
     else:
         gl.sync_clock(usrp, log, min_sync_time=ic.min_gps_lock_time)
-        gps_mon=gl.gpsdo_monitor(usrp, log, ic.gps_holdover_time)
+        gps_mon=gl.gpsdo_monitor(usrp, log, ic.gps_holdover_time, lock=usrp_lock)
 
     # start with first frequency on tx and rx
     tune_req=uhd.libpyuhd.types.tune_request(s.freq(0))
     usrp.set_tx_freq(tune_req)
     usrp.set_rx_freq(tune_req)
 
-    # hold SWR measurement about half of the transmit waveform length, so
-    # we have no timing issues
-    swr_buffer=n.empty(int(0.5*sample_rate*s.freq_dur), dtype=n.complex64)
+    # persistent transmit and reflected power streams
+    tx=tx_engine.tx_engine(usrp, ic, log, host_format=ic.tx_host_format, lock=usrp_lock)
+
+    # tuning, gpio and transmit bursts are issued ahead of time by the scheduler thread
+    sched=timed_scheduler.timed_scheduler(usrp, log, lock=usrp_lock)
 
     # figure out when to start the cycle
     t_now=usrp.get_time_now().get_real_secs()
@@ -201,23 +130,31 @@ def main(config):
     while not Exit:
         t0_dt = datetime.fromtimestamp(t0)
         log.log("Starting sweep at %1.2f (%s)" % (t0, t0_dt.strftime("%FT%T.%f")[:-3]))
-        for i in range(s.n_freqs):
-            f0, dt=s.pars(i)
-
-            print("f=%f code %s" % (f0/1e6, s.code(i)))
-            transmit_waveform(usrp, n.uint64(t0+dt), s.waveform(i), swr_buffer, f0, log, ic)
-
-            # tune to next frequency 0.0 s before end
-            next_freq_idx=(i+1) % s.n_freqs
-            tune_at(usrp, t0+dt+s.freq_dur-0.05, ic, f0=s.freq(next_freq_idx), gpio_state=gpio_state)
-            gpio_state=(gpio_state+1) % 2
-
-            # check that GPS is still locked.
+        # tune to next frequency 0.05 s before the end of each frequency
+        for e in timed_scheduler.sweep_timeline(s, t0, tune_offset=-0.05):
+            if e["kind"] == "burst":
+                sched.add(e["t"], tx.transmit, n.uint64(e["t"]), s.code_idx(e["fi"]), e["f0"], locked=False)
+            else:
+                sched.add(e["t"], tune_at, usrp, e["t"], ic, e["f0"], gpio_state)
+                gpio_state=(gpio_state+1) % 2
+
+        # schedule the next sweep shortly before this one ends
+        t_end=t0+s.n_freqs*s.freq_dur
+        while sched.usrp_time() < t_end-2*sched.lead_time:
+            time.sleep(min(1.0, max(0.0, t_end-2*sched.lead_time-sched.usrp_time())))
+            tx.check()
+            # check that GPS is still locked (cached by the monitor thread).
             if ic.require_gps:
                 gps_mon.check()
+        log.log(sched.summary())
 
         t0+=n.uint64(s.sweep_len_s)
 
+    # wait for the last sweep to be sent
+    sched.wait_until(t0-s.sweep_len_s+s.n_freqs*s.freq_dur)
+    sched.stop()
+    tx.close()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()